@@ -109,10 +109,10 @@ class BerezinianAblator(ModelAbliterator):
         directions = self.refusal_dirs()
         
         scores = {}
-        for key, direction in directions.items():
+        for key, layer, direction in zip(directions.names, directions.layers, directions.directions):
             # Calculate super-projection
             super_proj = self.get_super_projection(
-                int(re.search(r"\.(\d+)\.", key)[1]) if '.' in key else 0,
+                layer or 0,
                 direction,
                 is_even
             )
@@ -4,22 +4,39 @@ import functools
 import einops
 import gc
 import re
+import math
+import json
+import hashlib
+import time
+import tempfile
+import weakref
 from itertools import islice
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import Mapping
+from dataclasses import dataclass
 
 from datasets import load_dataset
 from sklearn.model_selection import train_test_split
 from tqdm import tqdm
 from torch import Tensor
-from typing import Callable, Dict, List, Set, Tuple, Optional
+from typing import Callable, Dict, List, Set, Tuple, Optional, Union
 from transformer_lens import HookedTransformer, utils, ActivationCache, loading
 from transformer_lens.hook_points import HookPoint
+from transformer_lens.past_key_value_caching import HookedTransformerKeyValueCache, HookedTransformerKeyValueCacheEntry
 from transformers import AutoTokenizer, AutoModelForCausalLM
 from jaxtyping import Float, Int
 
 import os
+import sys
 import shutil
 from pathlib import Path
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
+from safetensors import safe_open
 from safetensors.torch import load_file, save_file
 
 def batch(iterable, n):
@@ -65,16 +82,400 @@ def directional_hook(
     hook: HookPoint,
     direction: Float[Tensor, "d_model"]
 ) -> Float[Tensor, "... d_model"]:
-    if activation.device != direction.device:
-        direction = direction.to(activation.device)
+    # einsum doesn't promote dtypes, so the direction follows the activation (e.g. an fp32 direction on a bf16 model)
+    if activation.device != direction.device or activation.dtype != direction.dtype:
+        direction = direction.to(activation.device, activation.dtype)
 
     proj = einops.einsum(activation, direction.view(-1, 1), '... d_model, d_model single -> ... single') * direction
     return activation - proj
 
+def batched_directional_hook(
+    activation: Float[Tensor, "batch ... d_model"],
+    hook: HookPoint,
+    directions: Float[Tensor, "batch d_model"]
+) -> Float[Tensor, "batch ... d_model"]:
+    # directional_hook with a direction per batch row
+    if activation.device != directions.device or activation.dtype != directions.dtype:
+        directions = directions.to(activation.device, activation.dtype)
+
+    directions = directions.view(directions.shape[0], *([1] * (activation.dim() - 2)), directions.shape[-1])
+    proj = (activation * directions).sum(dim=-1, keepdim=True) * directions
+    return activation - proj
+
+def orthonormal_basis(directions: List[Float[Tensor, 'd_model']]) -> Float[Tensor, 'd_model k']:
+    # rank-revealing SVD of the stacked directions: the left singular vectors with non-negligible singular values are an
+    # orthonormal basis of their span, however many of the directions are (nearly) duplicates of each other
+    U, S, _ = torch.linalg.svd(torch.stack([d.to('cpu', torch.float32) for d in directions], dim=1), full_matrices=False)
+    return U[:, S > 1e-6 * S.max()]
+
+MODIFIABLE_WEIGHTS = {'W_O': 'blocks.{}.attn.W_O', 'mlp': 'blocks.{}.mlp.W_out'}
+
+@dataclass
+class WeightDelta:
+    """One logged edit of a W_O/W_out matrix, stored compactly so it can be replayed.
+
+    Low-rank edits are `matrix + coeffs @ directions.T` (coeffs [..., k], directions [d_model, k]), so the log costs
+    O(k * (d_model + rows)) per edit instead of a full matrix. Edits of unknown structure keep the `dense` replacement.
+    """
+    coeffs: Tensor = None
+    directions: Tensor = None
+    dense: Tensor = None
+    # content hash, filled in by CheckpointStore; deltas are never changed in place, so it stays valid
+    id: str = None
+
+    @classmethod
+    def projection(cls, matrix: Float[Tensor, '... d_model'], directions: Float[Tensor, 'd_model k'], scale: float = -1.0) -> Tuple[Float[Tensor, '... d_model'], 'WeightDelta']:
+        # matrix + scale * (matrix Q) Q^T and the delta that logs it: scale=-1 removes the span of Q, positive scales amplify it
+        directions = directions.to(matrix.device, matrix.dtype)
+        if directions.dim() == 1:
+            directions = directions.view(-1, 1)
+        coeffs = scale * (matrix @ directions)
+        return matrix + coeffs @ directions.T, cls(coeffs=coeffs.to('cpu'), directions=directions.to('cpu'))
+
+    def apply(self, matrix: Float[Tensor, '... d_model']) -> Float[Tensor, '... d_model']:
+        if self.dense is not None:
+            return self.dense.to(matrix.device, matrix.dtype)
+        return matrix + self.coeffs.to(matrix.device, matrix.dtype) @ self.directions.to(matrix.device, matrix.dtype).T
+
+    def pack(self) -> Dict[str, Tensor]:
+        # plain tensors only, so saved history loads with torch.load(weights_only=True)
+        return {k: v for k, v in (('coeffs', self.coeffs), ('directions', self.directions), ('dense', self.dense)) if v is not None}
+
+    @classmethod
+    def unpack(cls, packed) -> 'WeightDelta':
+        if isinstance(packed, (tuple, list)):
+            # history saved before deltas: (old, replacement) full copies
+            return cls(dense=packed[-1])
+        return cls(**packed)
+
+def copy_modified_layers(modified_layers: Dict[str, Dict[int, List[WeightDelta]]]) -> Dict[str, Dict[int, List[WeightDelta]]]:
+    # deltas are never changed in place, so copying the per-layer lists is enough
+    return {kind: {layer: list(deltas) for layer, deltas in layers.items()} for kind, layers in modified_layers.items()}
+
+def pack_modified_layers(modified_layers: Dict[str, Dict[int, List[WeightDelta]]]) -> Dict[str, Dict[int, List[Dict[str, Tensor]]]]:
+    return {kind: {layer: [delta.pack() for delta in deltas] for layer, deltas in layers.items()} for kind, layers in modified_layers.items()}
+
+def unpack_modified_layers(packed: Dict) -> Dict[str, Dict[int, List[WeightDelta]]]:
+    unpacked = {'mlp': {}, 'W_O': {}}
+    for kind, layers in (packed or {}).items():
+        unpacked[kind] = {layer: [WeightDelta.unpack(delta) for delta in (deltas if isinstance(deltas, list) else [deltas])] for layer, deltas in layers.items()}
+    return unpacked
+
+def apply_subspace_update(
+    ablator,
+    basis: Float[Tensor, 'd_model k'],
+    layers: List[int],
+    W_O: bool = True,
+    mlp: bool = True,
+    scale: float = -1.0,
+    batch_layers: bool = False
+):
+    # One read-modify-write per matrix through the ablator's `layer_attn`/`layer_mlp`, however many directions span `basis`.
+    # `batch_layers` stacks every layer's matrix (per device) into a single batched matmul, at the cost of a temporary copy
+    for enabled, layer_fn in ((W_O, ablator.layer_attn), (mlp, ablator.layer_mlp)):
+        if not enabled:
+            continue
+        if not batch_layers:
+            for layer in layers:
+                layer_fn(layer, *WeightDelta.projection(layer_fn(layer), basis, scale))
+            continue
+        groups = {}
+        for layer in layers:
+            matrix = layer_fn(layer)
+            groups.setdefault((matrix.device, matrix.dtype), []).append(layer)
+        for group in groups.values():
+            updated, delta = WeightDelta.projection(torch.stack([layer_fn(layer) for layer in group]), basis, scale)
+            for i, layer in enumerate(group):
+                layer_fn(layer, updated[i], WeightDelta(coeffs=delta.coeffs[i], directions=delta.directions))
+
+def get_reducing_hooks(
+    model: HookedTransformer,
+    names_filter: Callable[[str], bool] = None,
+    last_indices: int = 1
+) -> Tuple[Dict[str, Float[Tensor, 'batch_size d_model']], List[Tuple[str, Callable]]]:
+    # Like `get_caching_hooks`, but each hook keeps only the mean over the last `last_indices` positions,
+    # reduced on the activation's own device, so the cache holds [batch, d_model] instead of [batch, seq, d_model].
+    # The last positions are carried across forward passes, so incremental decoding reduces the same positions.
+    cache = {}
+    tails = {}
+
+    def reduce_hook(activation: Float[Tensor, 'batch_size seq_len d_model'], hook: HookPoint):
+        activation = activation.detach()
+        if hook.name in tails:
+            activation = torch.cat([tails[hook.name], activation], dim=1)
+        tails[hook.name] = activation[:, -last_indices:]
+        cache[hook.name] = torch.mean(tails[hook.name], dim=1)
+
+    return cache, [(name, reduce_hook) for name in model.hook_dict if names_filter is None or names_filter(name)]
+
+def get_appending_hooks(
+    model: HookedTransformer,
+    names_filter: Callable[[str], bool] = None,
+    device: str = None,
+    remove_batch_dim: bool = False
+) -> Tuple[Dict[str, Float[Tensor, 'batch_size seq_len d_model']], List[Tuple[str, Callable]]]:
+    # Like `get_caching_hooks`, but successive forward passes append their positions to the cache instead of
+    # replacing it, so a KV-cached generation (one new position per pass) still caches the whole sequence.
+    # Attention patterns/scores have no single position axis; those keep the latest pass.
+    cache = {}
+
+    def append_hook(activation: Tensor, hook: HookPoint):
+        activation = activation.detach().to(device) if device else activation.detach()
+        if remove_batch_dim:
+            activation = activation[0]
+        if hook.name in cache and not hook.name.endswith(('hook_pattern', 'hook_attn_scores')):
+            activation = torch.cat([cache[hook.name], activation], dim=0 if remove_batch_dim else 1)
+        cache[hook.name] = activation
+
+    return cache, [(name, append_hook) for name in model.hook_dict if names_filter is None or names_filter(name)]
+
+def decode_incrementally(
+    model: HookedTransformer,
+    toks: Int[Tensor, 'batch_size seq_len'],
+    max_tokens_generated: int,
+    *args,
+    **kwargs
+):
+    # Greedy decoding with a per-layer key/value cache: the prompt runs through the model once, then each step feeds
+    # only the newest token, so hooks see every position exactly once. Yields (logits of the new positions, next tokens);
+    # tokens passed back with `send` are fed instead of the argmax, e.g. EOS for rows that already finished.
+    cache = HookedTransformerKeyValueCache.init_cache(model.cfg, model.cfg.device, toks.shape[0])
+    step, attention_mask = toks, None
+    for _ in range(max_tokens_generated):
+        logits = model(step, *args, past_kv_cache=cache, attention_mask=attention_mask, **kwargs)
+        next_tokens = logits[:, -1, :].argmax(dim=-1)
+        sent = yield logits, next_tokens
+        if sent is not None:
+            next_tokens = sent
+        # generated tokens are always attended, even when they equal the pad token
+        step = next_tokens.view(-1, 1).to(toks.device)
+        attention_mask = torch.ones_like(step)
+
+class ContinuousBatcher:
+    """Greedy generation over a queue of prompts with a fixed number of batch slots.
+
+    A row leaves the batch as soon as it emits one of `stop_tokens` or reaches `max_tokens_generated`, and the next
+    queued prompt is prefilled into the freed slot, so a long completion no longer holds up the rest of its batch.
+    Rows of different lengths share one key/value cache by left padding. Hooks must treat rows alike, since a row's
+    position in the batch changes as others leave. `tokens_per_second` covers the last `run`.
+    """
+    def __init__(self, model: HookedTransformer, slots: int, max_tokens_generated: int = 64, stop_tokens: Set[int] = None, model_args: Tuple = (), **model_kwargs):
+        self.model = model
+        self.model_args = tuple(model_args)
+        self.slots = slots
+        self.max_tokens_generated = max_tokens_generated
+        self.stop_tokens = set(stop_tokens or ())
+        self.model_kwargs = model_kwargs
+        self.tokens_generated = 0
+        self.tokens_per_second = None
+
+    def prefill(self, prompts: List[List[int]]) -> Tuple[HookedTransformerKeyValueCache, Tensor]:
+        length = max(len(ids) for ids in prompts)
+        toks = torch.full((len(prompts), length), self.model.tokenizer.pad_token_id, dtype=torch.long)
+        mask = torch.zeros((len(prompts), length), dtype=torch.long)
+        for i, ids in enumerate(prompts):
+            toks[i, length - len(ids):] = torch.as_tensor(ids, dtype=torch.long)
+            mask[i, length - len(ids):] = 1
+        cache = HookedTransformerKeyValueCache.init_cache(self.model.cfg, self.model.cfg.device, len(prompts))
+        logits = self.model(toks.to(self.model.cfg.device), *self.model_args, past_kv_cache=cache, attention_mask=mask, **self.model_kwargs)
+        return cache, logits[:, -1, :].argmax(dim=-1).to('cpu')
+
+    @staticmethod
+    def merge(a: HookedTransformerKeyValueCache, b: HookedTransformerKeyValueCache) -> HookedTransformerKeyValueCache:
+        # stack two caches along the batch, left padding the shorter one (padding is masked out of attention and positions)
+        length = max(a.previous_attention_mask.shape[1], b.previous_attention_mask.shape[1])
+        def pad(t: Tensor) -> Tensor:
+            if t.shape[1] == length:
+                return t
+            return torch.cat([t.new_zeros((t.shape[0], length - t.shape[1], *t.shape[2:])), t], dim=1)
+        return HookedTransformerKeyValueCache(
+            entries=[
+                HookedTransformerKeyValueCacheEntry(torch.cat([pad(x.past_keys), pad(y.past_keys)]), torch.cat([pad(x.past_values), pad(y.past_values)]))
+                for x, y in zip(a.entries, b.entries)
+            ],
+            previous_attention_mask=torch.cat([pad(a.previous_attention_mask), pad(b.previous_attention_mask)])
+        )
+
+    @staticmethod
+    def keep(cache: HookedTransformerKeyValueCache, rows: Tensor) -> HookedTransformerKeyValueCache:
+        # drop retired rows, then any leading positions that are padding for every row left
+        mask = cache.previous_attention_mask[rows.to(cache.previous_attention_mask.device)]
+        start = int(mask.any(dim=0).int().argmax())
+        cache.previous_attention_mask = mask[:, start:]
+        for entry in cache.entries:
+            entry.past_keys = entry.past_keys[rows.to(entry.past_keys.device), start:]
+            entry.past_values = entry.past_values[rows.to(entry.past_values.device), start:]
+        return cache
+
+    def run(self, prompts: List[List[int]]):
+        # yields (prompt index, generated token ids) as each row finishes, not in prompt order
+        queue = deque(enumerate(prompts))
+        cache, active, generated = None, [], []
+        self.tokens_generated = 0
+        start = time.perf_counter()
+        while queue or active:
+            if queue and len(active) < self.slots:
+                admitted = [queue.popleft() for _ in range(min(self.slots - len(active), len(queue)))]
+                new_cache, next_tokens = self.prefill([ids for _, ids in admitted])
+                cache = new_cache if cache is None else self.merge(cache, new_cache)
+                rows = range(len(active), len(active) + len(admitted))
+                active += [i for i, _ in admitted]
+                generated += [[] for _ in admitted]
+            else:
+                step = torch.tensor([tokens[-1] for tokens in generated], dtype=torch.long).view(-1, 1)
+                logits = self.model(step.to(self.model.cfg.device), *self.model_args, past_kv_cache=cache, attention_mask=torch.ones_like(step), **self.model_kwargs)
+                next_tokens = logits[:, -1, :].argmax(dim=-1).to('cpu')
+                rows = range(len(active))
+            done = []
+            for row, token in zip(rows, next_tokens.tolist()):
+                generated[row].append(token)
+                self.tokens_generated += 1
+                if token in self.stop_tokens or len(generated[row]) >= self.max_tokens_generated:
+                    done.append(row)
+            if done:
+                for row in done:
+                    yield active[row], generated[row]
+                kept = [row for row in range(len(active)) if row not in done]
+                active = [active[row] for row in kept]
+                generated = [generated[row] for row in kept]
+                cache = self.keep(cache, torch.tensor(kept, dtype=torch.long)) if kept else None
+        elapsed = time.perf_counter() - start
+        self.tokens_per_second = self.tokens_generated / elapsed if elapsed > 0 else None
+
+@functools.lru_cache(maxsize=32)
+def token_index(token_ids: Tuple[int, ...], device: str) -> Int[Tensor, 'n_toks']:
+    return torch.tensor(token_ids, dtype=torch.long, device=device)
+
+def token_probabilities(
+    logits: Float[Tensor, 'batch_size seq_len d_vocab'],
+    token_ids: List[int]|Tuple[int]|Set[int]|Int[Tensor, '...']
+) -> Float[Tensor, 'batch_size seq_len n_toks']:
+    # softmax probabilities of just `token_ids`, on the logits' own device: one logsumexp per position and a gather,
+    # rather than normalizing the whole vocabulary; only [batch, seq, n_toks] is left to move to the host
+    index = token_index(tuple(int(t) for t in token_ids), str(logits.device))
+    logits = logits.float()
+    selected = logits.gather(-1, index.expand(*logits.shape[:-1], -1))
+    return torch.exp(selected - torch.logsumexp(logits, dim=-1, keepdim=True))
+
 def clear_mem():
     gc.collect()
     torch.cuda.empty_cache()
 
+def host_memory_peak(reset: bool = False) -> Optional[int]:
+    # Peak resident memory of this process, in bytes. `reset=True` first restarts the high-water mark at the current
+    # resident size where the OS allows it (Linux); otherwise it's the lifetime peak, which only grows.
+    if reset:
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            pass
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def is_out_of_memory(e: Exception) -> bool:
+    if isinstance(e, torch.cuda.OutOfMemoryError):
+        return True
+    return isinstance(e, RuntimeError) and ('out of memory' in str(e) or "can't allocate memory" in str(e))
+
+class BatchSizeController:
+    """Chooses batch sizes that keep peak memory under `memory_budget` bytes.
+
+    Per-token memory cost is learned from completed batches: peak CUDA allocation over the pre-batch baseline (worst
+    device), or on CPU the growth of the process's peak resident memory, falling back to `bytes_per_token` until a
+    batch has been measured. Where the OS can't reset the resident peak, only batches that raise it are measured.
+    A batch that runs out of memory is retried at half size. Every size used is kept in `sizes`.
+    """
+    def __init__(self, memory_budget: int, initial: int = 8, min_size: int = 1, max_size: int = None, bytes_per_token: float = None, headroom: float = 0.9):
+        self.memory_budget = memory_budget
+        self.initial = initial
+        self.min_size = min_size
+        self.max_size = max_size
+        self.estimate = bytes_per_token
+        self.bytes_per_token = None
+        self.headroom = headroom
+        self.ceiling = max_size
+        self.sizes = []
+        self.retries = 0
+
+    @classmethod
+    def for_model(cls, model: HookedTransformer, memory_budget: int, batch_size: int, logits: bool = False):
+        # rough working set of one token's forward: a block's activations, plus fp32 logits when generating
+        cfg = model.cfg
+        per_token = (cfg.d_mlp + 8*cfg.d_model) * torch.finfo(cfg.dtype).bits // 8
+        if logits:
+            per_token += cfg.d_vocab * 4
+        return cls(memory_budget, initial=batch_size, bytes_per_token=per_token)
+
+    def next_size(self, seq_len: int) -> int:
+        per_token = self.bytes_per_token or self.estimate
+        if per_token is None:
+            size = self.initial
+        else:
+            size = int(self.memory_budget * self.headroom // (per_token * max(seq_len, 1)))
+            if self.sizes:
+                # grow at most 2x per step; the learned cost can undershoot on short batches
+                size = min(size, 2*self.sizes[-1])
+        if self.ceiling is not None:
+            size = min(size, self.ceiling)
+        return max(size, self.min_size)
+
+    def record(self, size: int, seq_len: int, peak: int = None):
+        self.sizes.append(size)
+        if peak is not None and peak > 0:
+            self.bytes_per_token = max(self.bytes_per_token or 0, peak / (size * max(seq_len, 1)))
+
+    def shrink(self, size: int, seq_len: int):
+        self.retries += 1
+        self.ceiling = max(self.min_size, size // 2)
+        self.bytes_per_token = max(self.bytes_per_token or 0, self.memory_budget / (size * max(seq_len, 1)))
+
+    def run(
+        self,
+        total: int,
+        take: Callable[[int, int], Tuple],
+        process: Callable,
+        seq_len: Callable[[int, int], int]
+    ):
+        # `take(start, size)` builds the arguments for `process`, `seq_len(start, size)` is the longest sequence in that window
+        devices = [torch.device('cuda', i) for i in range(torch.cuda.device_count())] if torch.cuda.is_available() else []
+        start = 0
+        with tqdm(total=total) as progress:
+            while start < total:
+                size = min(self.next_size(seq_len(start, 1)), total-start)
+                size = min(size, self.next_size(seq_len(start, size)))
+                window = seq_len(start, size)
+
+                baselines = []
+                for device in devices:
+                    torch.cuda.reset_peak_memory_stats(device)
+                    baselines.append(torch.cuda.memory_allocated(device))
+                host_baseline = None if devices else host_memory_peak(reset=True)
+                try:
+                    process(*take(start, size))
+                except Exception as e:
+                    if not is_out_of_memory(e) or size <= self.min_size:
+                        raise
+                    clear_mem()
+                    self.shrink(size, window)
+                    continue
+
+                peak = max((torch.cuda.max_memory_allocated(device)-baseline for device,baseline in zip(devices,baselines)), default=None)
+                if host_baseline is not None:
+                    peak = host_memory_peak() - host_baseline
+                self.record(size, window, peak)
+                start += size
+                progress.update(size)
+
 def measure_fn(measure: str, input_tensor: Tensor, *args, **kwargs) -> Float[Tensor, '...']:
     avail_measures = {
         'mean': torch.mean,
@@ -88,6 +489,913 @@ def measure_fn(measure: str, input_tensor: Tensor, *args, **kwargs) -> Float[Ten
     except KeyError:
         raise NotImplementedError(f"Unknown measure function '{measure}'. Available measures:" + ', '.join([f"'{str(fn)}'" for fn in avail_measures.keys()]) )
 
+class RunningStats:
+    """Streaming float32 mean (and optionally covariance) of activation rows.
+
+    Batches are folded in with Chan's parallel Welford update, so memory stays at O(d_model)
+    (O(d_model^2) with covariance) no matter how many prompts are seen.
+    """
+    def __init__(self, covariance: bool = False):
+        self.n = 0
+        self.mean = None
+        self.M2 = None
+        self.track_covariance = covariance
+
+    def update(self, rows: Float[Tensor, 'batch d_model']) -> 'RunningStats':
+        rows = rows.to(torch.float32)
+        batch_n = rows.shape[0]
+        if batch_n == 0:
+            return self
+
+        batch_mean = torch.mean(rows, dim=0)
+        if self.mean is None:
+            self.mean = torch.zeros_like(batch_mean)
+            if self.track_covariance:
+                self.M2 = torch.zeros((batch_mean.shape[0], batch_mean.shape[0]), dtype=torch.float32, device=batch_mean.device)
+
+        delta = batch_mean.to(self.mean.device) - self.mean
+        total = self.n + batch_n
+        self.mean += delta * (batch_n / total)
+        if self.track_covariance:
+            centered = (rows - batch_mean).to(self.M2.device)
+            self.M2 += centered.T @ centered + torch.outer(delta, delta) * (self.n * batch_n / total)
+        self.n = total
+        return self
+
+    def merge(self, other: 'RunningStats') -> 'RunningStats':
+        # combined statistics of both streams, neither input is modified
+        merged = RunningStats(covariance=self.track_covariance and other.track_covariance)
+        for stats in (self, other):
+            if stats.n == 0:
+                continue
+            if merged.n == 0:
+                merged.n = stats.n
+                merged.mean = stats.mean.clone()
+                merged.M2 = stats.M2.clone() if merged.track_covariance else None
+                continue
+            delta = stats.mean.to(merged.mean.device) - merged.mean
+            total = merged.n + stats.n
+            merged.mean += delta * (stats.n / total)
+            if merged.track_covariance:
+                merged.M2 += stats.M2.to(merged.M2.device) + torch.outer(delta, delta) * (merged.n * stats.n / total)
+            merged.n = total
+        return merged
+
+    def covariance(self) -> Float[Tensor, 'd_model d_model']:
+        if not self.track_covariance:
+            raise ValueError("Covariance was not tracked; create the stats with covariance=True")
+        return self.M2 / max(self.n - 1, 1)
+
+    def to(self, device) -> 'RunningStats':
+        if self.mean is not None:
+            self.mean = self.mean.to(device)
+        if self.M2 is not None:
+            self.M2 = self.M2.to(device)
+        return self
+
+    def __len__(self):
+        return self.n
+
+class CompactActivations:
+    """Per-prompt activation rows kept in a compact format and dequantized on demand.
+
+    'int8' quantizes each incoming chunk of rows with per-channel float32 scales (absmax / 127), so
+    every stored value is within half a scale step of the original. 'fp16' keeps half-precision rows
+    next to an exact float32 sum, so the mean that directions are built from carries no storage error.
+    """
+    FORMATS = ('int8', 'fp16')
+
+    def __init__(self, compact: str = 'int8'):
+        if compact not in self.FORMATS:
+            raise ValueError(f"Unknown compact format '{compact}'. Available formats: " + ', '.join(f"'{f}'" for f in self.FORMATS))
+        self.format = compact
+        self.chunks = []
+        self.scales = []
+        self.sum = None
+        self.perm = None
+
+    def update(self, rows: Float[Tensor, 'batch d_model']) -> 'CompactActivations':
+        if rows.shape[0] == 0:
+            return self
+        rows = rows.detach()
+        if self.format == 'int8':
+            rows = rows.to(torch.float32)
+            scale = rows.abs().amax(dim=0).clamp(min=torch.finfo(torch.float32).tiny) / 127
+            self.chunks.append(torch.round(rows / scale).to(torch.int8))
+            self.scales.append(scale)
+        else:
+            self.chunks.append(rows.to(torch.float16, copy=True))
+            batch_sum = rows.to(torch.float32).sum(dim=0)
+            self.sum = batch_sum if self.sum is None else self.sum + batch_sum.to(self.sum.device)
+        if self.perm is not None:
+            # rows added after a reorder stay in arrival order
+            self.perm = torch.cat((self.perm, torch.arange(len(self.perm), len(self.perm) + rows.shape[0])))
+        return self
+
+    def reorder(self, perm: Int[Tensor, 'n']) -> 'CompactActivations':
+        self.perm = perm.to('cpu') if self.perm is None else self.perm[perm.to('cpu')]
+        return self
+
+    def merge(self, other: 'CompactActivations') -> 'CompactActivations':
+        # rows of `self` followed by rows of `other`, neither input is modified
+        if other.format != self.format:
+            other = CompactActivations(self.format).update(other.dequantize())
+        merged = CompactActivations(self.format)
+        merged.chunks = self.chunks + other.chunks
+        merged.scales = self.scales + other.scales
+        if self.sum is not None or other.sum is not None:
+            merged.sum = sum(s.to('cpu') for s in (self.sum, other.sum) if s is not None)
+        if self.perm is not None or other.perm is not None:
+            n = len(self)
+            merged.perm = torch.cat((
+                self.perm if self.perm is not None else torch.arange(n),
+                (other.perm if other.perm is not None else torch.arange(len(other))) + n
+            ))
+        return merged
+
+    def dequantize(self) -> Float[Tensor, 'n d_model']:
+        if self.format == 'int8':
+            rows = torch.cat([chunk.to(torch.float32) * scale.to(chunk.device) for chunk, scale in zip(self.chunks, self.scales)], dim=0)
+        else:
+            rows = torch.cat([chunk.to(torch.float32) for chunk in self.chunks], dim=0)
+        return rows if self.perm is None else rows[self.perm.to(rows.device)]
+
+    def mean(self) -> Float[Tensor, 'd_model']:
+        # chunk by chunk, without materializing all the rows in float32
+        if self.format == 'fp16':
+            return self.sum / len(self)
+        return sum(chunk.to(torch.float32).sum(dim=0) * scale.to(chunk.device) for chunk, scale in zip(self.chunks, self.scales)) / len(self)
+
+    def mean_error_bound(self) -> Float[Tensor, 'd_model']:
+        # per-channel bound on |mean() - exact mean|: rounding moves each int8 value by at most scale / 2
+        if self.format == 'fp16':
+            return torch.zeros_like(self.sum)
+        return sum(chunk.shape[0] * scale / 2 for chunk, scale in zip(self.chunks, self.scales)) / len(self)
+
+    @property
+    def shape(self) -> torch.Size:
+        return torch.Size((len(self), self.chunks[0].shape[1] if self.chunks else 0))
+
+    def nbytes(self) -> int:
+        return sum(t.numel() * t.element_size() for t in self.chunks + self.scales)
+
+    def __len__(self):
+        return sum(chunk.shape[0] for chunk in self.chunks)
+
+def activation_mean(acts: Tensor|RunningStats|CompactActivations) -> Float[Tensor, 'd_model']:
+    # cached activations are per-prompt rows (possibly compact) or streamed statistics
+    if isinstance(acts, RunningStats):
+        return acts.mean
+    if isinstance(acts, CompactActivations):
+        return acts.mean()
+    return torch.mean(acts, dim=0)
+
+def activation_rows(acts: Tensor|CompactActivations) -> Float[Tensor, 'n d_model']:
+    if isinstance(acts, RunningStats):
+        raise ValueError("Streamed activations only keep statistics; cache with streaming=False for per-prompt rows")
+    if isinstance(acts, CompactActivations):
+        return acts.dequantize()
+    return acts
+
+def direction_error_bound(a: Tensor|RunningStats|CompactActivations, b: Tensor|RunningStats|CompactActivations, direction: Float[Tensor, 'd_model']) -> float:
+    # bound on the L2 error of the normalized `direction` (mean of a - mean of b) caused by compact storage;
+    # perturbing v by e moves v/|v| by at most 2|e|/|v|
+    bounds = [acts.mean_error_bound().to(direction.device) for acts in (a, b) if isinstance(acts, CompactActivations)]
+    if not bounds:
+        return 0.0
+    return (2 * sum(bounds).norm() / direction.norm()).item()
+
+def parse_act_name(name: str) -> Tuple[int|None, str]:
+    # 'blocks.3.hook_resid_pre' -> (3, 'resid_pre'); names outside the blocks (e.g. 'hook_embed') have no layer
+    s = re.match(r"blocks\.(\d+)\.", name)
+    return (int(s[1]) if s else None), name.rsplit('hook_', 1)[-1]
+
+def direction_keys(keys) -> List[str]:
+    # layer 0 is left out, as its direction often becomes NaN
+    return [key for key in keys if parse_act_name(key)[0] != 0]
+
+class DirectionBank(Mapping):
+    """Unit directions for many act names, stored as one contiguous [K, d_model] tensor.
+
+    Reads like the `{act_name: direction}` dict it replaces, and adds lookup by (layer, act type)
+    and top-k selection by score.
+    """
+    def __init__(self, names: List[str], directions: Float[Tensor, 'K d_model']):
+        self.names = list(names)
+        self.directions = directions
+        self.index = {name: i for i, name in enumerate(self.names)}
+        parsed = [parse_act_name(name) for name in self.names]
+        self.layers = [layer for layer, act in parsed]
+        self.by_layer = {key: i for i, key in enumerate(parsed)}
+
+    @classmethod
+    def from_means(cls, names: List[str], a: Float[Tensor, 'K d_model'], b: Float[Tensor, 'K d_model']) -> 'DirectionBank':
+        # one batched difference and normalization for every name
+        diff = a - b
+        return cls(names, diff / diff.norm(dim=-1, keepdim=True))
+
+    def lookup(self, layer: int, act: str) -> Float[Tensor, 'd_model']:
+        return self.directions[self.by_layer[(layer, act)]]
+
+    def scores(self) -> Float[Tensor, 'K']:
+        # the magnitude of a direction's mean component, what `scored_dirs` has always ranked by
+        return self.directions.mean(dim=-1).abs()
+
+    def topk(self, k: int = None, scores: Float[Tensor, 'K'] = None, names: List[str] = None) -> List[Tuple[str, Float[Tensor, 'd_model']]]:
+        # highest scoring directions first, optionally restricted to `names`
+        scores = self.scores() if scores is None else torch.nan_to_num(scores, nan=float('-inf'))
+        idx = torch.arange(len(self.names)) if names is None else torch.tensor([self.index[name] for name in names if name in self.index], dtype=torch.long)
+        k = len(idx) if k is None else min(k, len(idx))
+        top = idx[torch.topk(scores[idx], k).indices] if k else idx[:0]
+        return [(self.names[i], self.directions[i]) for i in top.tolist()]
+
+    def __getitem__(self, name: str) -> Float[Tensor, 'd_model']:
+        return self.directions[self.index[name]]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+def separation_metrics(a: Float[Tensor, 'n_dirs n_a'], b: Float[Tensor, 'n_dirs n_b']) -> Dict[str, Float[Tensor, 'n_dirs']]:
+    # how well projections `a` sit above projections `b`, for every candidate row at once
+    n_a, n_b = a.shape[1], b.shape[1]
+    pooled_std = torch.sqrt(((n_a-1) * a.var(dim=1) + (n_b-1) * b.var(dim=1)) / max(n_a+n_b-2, 1))
+    # AUC through the Mann-Whitney rank sum; tied scores share their average rank, i.e. count half
+    scores = torch.cat((a, b), dim=1).to(torch.float64)
+    ordered = scores.sort(dim=1).values
+    below, up_to = torch.searchsorted(ordered, scores), torch.searchsorted(ordered, scores, right=True)
+    ranks = (below + up_to + 1).to(torch.float64) / 2
+    auc = (ranks[:, :n_a].sum(dim=1) - n_a*(n_a+1)/2) / (n_a*n_b)
+    return {
+        'auc': auc.to(torch.float32),
+        'cohens_d': (a.mean(dim=1) - b.mean(dim=1)) / pooled_std,
+        'margin': a.min(dim=1).values - b.max(dim=1).values
+    }
+
+def left_pad(ids: List[List[int]], pad_token_id: int) -> Int[Tensor, 'batch_size seq_len']:
+    seq_len = max((len(row) for row in ids), default=0)
+    toks = torch.full((len(ids), seq_len), pad_token_id, dtype=torch.long)
+    for i, row in enumerate(ids):
+        toks[i, seq_len-len(row):] = torch.as_tensor(row, dtype=torch.long)
+    return toks
+
+class BatchPlan:
+    """Prompts tokenized without padding and batched in order of token length.
+
+    Each batch is left-padded only to its own longest prompt; `order` keeps the original
+    prompt indices so callers can put per-prompt results back in dataset order.
+    """
+    def __init__(self, ids: List[List[int]], pad_token_id: int, batch_size: int, prompts: List[str] = None):
+        self.ids = ids
+        self.pad_token_id = pad_token_id
+        self.batch_size = batch_size
+        self.prompts = prompts
+        # a `TokenizedDataset` knows its row lengths without reading the rows
+        self.lengths = ids.lengths() if isinstance(ids, TokenizedDataset) else [len(row) for row in ids]
+        # stable sort, so equal-length prompts keep their dataset order
+        self.order = sorted(range(len(ids)), key=lambda i: self.lengths[i])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def num_batches(self) -> int:
+        return -(-len(self.ids) // self.batch_size)
+
+    def pad(self, indices: List[int]) -> Int[Tensor, 'batch_size seq_len']:
+        return left_pad([self.ids[i] for i in indices], self.pad_token_id)
+
+    def batches(self):
+        for i in range(0, len(self.order), self.batch_size):
+            indices = self.order[i:i+self.batch_size]
+            yield indices, self.pad(indices)
+
+    def take(self, start: int, size: int) -> Tuple[List[int], Int[Tensor, 'batch_size seq_len']]:
+        indices = self.order[start:start+size]
+        return indices, self.pad(indices)
+
+    def seq_len(self, start: int, size: int) -> int:
+        # prompts are sorted by length, so the last one in the window is the longest
+        return self.lengths[self.order[min(start+size, len(self.order))-1]]
+
+    def stats(self) -> Dict[str, float]:
+        lengths = self.lengths
+        real = sum(lengths)
+        padded = sum(len(chunk)*max(lengths[i] for i in chunk) for chunk in batch(self.order, self.batch_size))
+        unbucketed = len(lengths)*max(lengths, default=0)
+        return {
+            'prompts': len(lengths),
+            'batches': self.num_batches(),
+            'padding_waste': 1 - real/padded if padded else 0.0,
+            'unbucketed_padding_waste': 1 - real/unbucketed if unbucketed else 0.0
+        }
+
+def token_batches(toks: Int[Tensor, 'batch_size seq_len']|BatchPlan, N: int, batch_size: int):
+    # yields (original prompt indices, token batch) for either a padded tensor or a BatchPlan
+    if isinstance(toks, BatchPlan):
+        yield from toks.batches()
+        return
+    for i in range(0, min(N, len(toks)), batch_size):
+        end = min(i+batch_size, len(toks))
+        yield list(range(i, end)), toks[i:end]
+
+def restore_order(indices: List[int]) -> Int[Tensor, 'n']|None:
+    # permutation putting rows collected in `indices` order back into prompt order, None if already in order
+    if all(a < b for a, b in zip(indices, indices[1:])):
+        return None
+    return torch.argsort(torch.tensor(indices))
+
+class ActivationDiskCache:
+    """Content-addressed on-disk cache of per-prompt reduced activations, evicted least-recently-used first.
+
+    Each entry is one safetensors file holding a [d_model] row per hook name. Recency is the file's
+    mtime, so the LRU order carries over between runs.
+    """
+    def __init__(self, root: str, budget: int = 8 * 2**30):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.budget = budget
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        for path in sorted(self.root.glob("*/*.safetensors"), key=lambda p: p.stat().st_mtime):
+            self.entries[path] = path.stat().st_size
+        self.size = sum(self.entries.values())
+
+    def key(self, *parts) -> str:
+        return hashlib.sha256('\x00'.join(str(part) for part in parts).encode()).hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}.safetensors"
+
+    def get(self, key: str, names: List[str]) -> Dict[str, Tensor]|None:
+        path = self.path(key)
+        if path not in self.entries:
+            self.misses += 1
+            return None
+        with safe_open(path, framework='pt', device='cpu') as f:
+            if not all(name in f.keys() for name in names):
+                self.misses += 1
+                return None
+            rows = {name:f.get_tensor(name) for name in names}
+        os.utime(path)
+        self.entries.move_to_end(path)
+        self.hits += 1
+        return rows
+
+    def put(self, key: str, rows: Dict[str, Tensor]):
+        path = self.path(key)
+        if path in self.entries:
+            # keep hook names cached by earlier runs that this one didn't ask for
+            with safe_open(path, framework='pt', device='cpu') as f:
+                rows = {**{name:f.get_tensor(name) for name in f.keys()}, **rows}
+            self.size -= self.entries.pop(path)
+        path.parent.mkdir(exist_ok=True)
+        tmp = path.with_suffix('.tmp')
+        save_file({name:row.detach().to('cpu').contiguous() for name,row in rows.items()}, tmp)
+        os.replace(tmp, path)
+        self.entries[path] = path.stat().st_size
+        self.size += self.entries[path]
+        self.evict()
+
+    def evict(self):
+        while self.size > self.budget and self.entries:
+            path, size = self.entries.popitem(last=False)
+            path.unlink(missing_ok=True)
+            self.size -= size
+
+def merge_activations(old: Mapping, new: Mapping, model: HookedTransformer = None) -> Dict[str, Tensor|RunningStats]|ActivationCache:
+    # Adds newly cached prompts onto an existing cache: rows are concatenated, streamed stats are merged
+    if not old:
+        return new
+    if not new:
+        return old
+    merged = {}
+    new_keys = set(new.keys())
+    for key in old.keys():
+        if key not in new_keys:
+            # not cached this time (e.g. the stop layer moved up), so the earlier statistics stand as they are
+            merged[key] = old[key]
+            continue
+        old_acts, new_acts = old[key], new[key]
+        if isinstance(old_acts, RunningStats) or isinstance(new_acts, RunningStats):
+            # raw rows converted here track covariance if the stats they join do, so the merge keeps it
+            covariance = any(isinstance(acts, RunningStats) and acts.track_covariance for acts in (old_acts, new_acts))
+            old_acts = old_acts if isinstance(old_acts, RunningStats) else RunningStats(covariance).update(activation_rows(old_acts))
+            new_acts = new_acts if isinstance(new_acts, RunningStats) else RunningStats(covariance).update(activation_rows(new_acts))
+            merged[key] = old_acts.merge(new_acts)
+        elif isinstance(old_acts, CompactActivations) or isinstance(new_acts, CompactActivations):
+            compact = (old_acts if isinstance(old_acts, CompactActivations) else new_acts).format
+            old_acts = old_acts if isinstance(old_acts, CompactActivations) else CompactActivations(compact).update(old_acts)
+            new_acts = new_acts if isinstance(new_acts, CompactActivations) else CompactActivations(compact).update(new_acts)
+            merged[key] = old_acts.merge(new_acts)
+        else:
+            merged[key] = torch.cat((old_acts.to(new_acts.device), new_acts), dim=0)
+    if model is not None and isinstance(new, ActivationCache) and all(isinstance(v, Tensor) for v in merged.values()):
+        return ActivationCache(merged, model)
+    return merged
+
+ACTIVATION_STORE_MANIFEST = 'manifest.json'
+ACTIVATION_STORE_STATE = 'state.pt'
+ACTIVATION_STORE_CHECKPOINTS = 'checkpoints'
+
+def activation_kind(acts: Tensor|RunningStats|CompactActivations) -> str:
+    if isinstance(acts, RunningStats):
+        return 'stats'
+    if isinstance(acts, CompactActivations):
+        return acts.format
+    return 'rows'
+
+def save_activation_shard(path: Path, acts: Tensor|RunningStats|CompactActivations):
+    if isinstance(acts, RunningStats):
+        tensors = {'mean': acts.mean}
+        if acts.M2 is not None:
+            tensors['M2'] = acts.M2
+        metadata = {'kind': 'stats', 'n': str(acts.n)}
+    elif isinstance(acts, CompactActivations):
+        tensors = {'rows': torch.cat(acts.chunks, dim=0), 'chunk_rows': torch.tensor([chunk.shape[0] for chunk in acts.chunks])}
+        if acts.scales:
+            tensors['scales'] = torch.stack(acts.scales)
+        if acts.sum is not None:
+            tensors['sum'] = acts.sum
+        if acts.perm is not None:
+            tensors['perm'] = acts.perm
+        metadata = {'kind': acts.format}
+    else:
+        tensors = {'rows': acts}
+        metadata = {'kind': 'rows'}
+    save_file({k:v.detach().to('cpu').contiguous() for k,v in tensors.items()}, path, metadata=metadata)
+
+def load_activation_shard(path: Path) -> Tensor|RunningStats:
+    # safe_open maps the shard, so only the tensors of this one hook are read in
+    with safe_open(path, framework='pt', device='cpu') as f:
+        metadata = f.metadata() or {}
+        if metadata.get('kind') in CompactActivations.FORMATS:
+            acts = CompactActivations(metadata['kind'])
+            acts.chunks = list(f.get_tensor('rows').split(f.get_tensor('chunk_rows').tolist()))
+            acts.scales = list(f.get_tensor('scales')) if 'scales' in f.keys() else []
+            acts.sum = f.get_tensor('sum') if 'sum' in f.keys() else None
+            acts.perm = f.get_tensor('perm') if 'perm' in f.keys() else None
+            return acts
+        if metadata.get('kind') != 'stats':
+            return f.get_tensor('rows')
+        stats = RunningStats(covariance='M2' in f.keys())
+        stats.n = int(metadata['n'])
+        stats.mean = f.get_tensor('mean')
+        stats.M2 = f.get_tensor('M2') if stats.track_covariance else None
+        return stats
+
+class LazyActivations(Mapping):
+    """Read-only view over one group (e.g. 'harmful') of an on-disk activation store."""
+    def __init__(self, root: Path, entries: Dict[str, dict]):
+        self.root = Path(root)
+        self.entries = entries
+
+    def __getitem__(self, key: str) -> Tensor|RunningStats:
+        return load_activation_shard(self.root / self.entries[key]['file'])
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+def save_activation_store(dirname: str, groups: Dict[str, Mapping], state: Dict = None):
+    """Write one safetensors shard per hook name and group, plus a JSON manifest indexing them"""
+    root = Path(dirname)
+    manifest = {'version': 1, 'groups': {}}
+    for group, acts in groups.items():
+        (root / group).mkdir(parents=True, exist_ok=True)
+        manifest['groups'][group] = {}
+        for key in acts.keys():
+            tensor = acts[key]
+            fname = f"{group}/{key}.safetensors"
+            save_activation_shard(root / fname, tensor)
+            manifest['groups'][group][key] = {
+                'file': fname,
+                'kind': activation_kind(tensor),
+                'shape': list(tensor.mean.shape if isinstance(tensor, RunningStats) else tensor.shape),
+                'n': len(tensor)
+            }
+    state = {k:v for k,v in (state or {}).items() if v is not None}
+    if state:
+        torch.save(state, root / ACTIVATION_STORE_STATE)
+        manifest['state'] = ACTIVATION_STORE_STATE
+    # manifest goes last, so an interrupted save is never picked up as a complete store
+    with open(root / ACTIVATION_STORE_MANIFEST, 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+def load_activation_store(dirname: str) -> Tuple[Dict[str, LazyActivations], Dict]:
+    root = Path(dirname)
+    with open(root / ACTIVATION_STORE_MANIFEST) as f:
+        manifest = json.load(f)
+    groups = {group: LazyActivations(root, entries) for group, entries in manifest['groups'].items()}
+    state = torch.load(root / manifest['state'], map_location='cpu') if 'state' in manifest else {}
+    return groups, state
+
+class CheckpointStore:
+    """On-disk history of `modified_layers` checkpoints.
+
+    Every WeightDelta is written once, as a safetensors file named by its content hash, and shared by all the
+    checkpoints that contain it. A checkpoint is a small JSON manifest of each edited matrix's delta ids, so
+    checkpoints cost disk rather than RAM, and matrices differ between two checkpoints exactly when their id lists do.
+    """
+    def __init__(self, root: str = None):
+        self._root = Path(root) if root else None
+
+    @property
+    def root(self) -> Path:
+        # a throwaway directory unless one was given, created on first use
+        if self._root is None:
+            self._root = Path(tempfile.mkdtemp(prefix='abliterator-checkpoints-'))
+            weakref.finalize(self, shutil.rmtree, self._root, True)
+        (self._root / 'deltas').mkdir(parents=True, exist_ok=True)
+        (self._root / 'checkpoints').mkdir(parents=True, exist_ok=True)
+        return self._root
+
+    def ids(self) -> List[int]:
+        if self._root is None or not (self._root / 'checkpoints').exists():
+            return []
+        return sorted(int(p.stem) for p in (self._root / 'checkpoints').glob('*.json'))
+
+    @staticmethod
+    def delta_id(delta: WeightDelta) -> str:
+        if delta.id is None:
+            h = hashlib.sha256()
+            for name, tensor in sorted(delta.pack().items()):
+                tensor = tensor.detach().to('cpu').contiguous()
+                h.update(f"{name}|{tensor.dtype}|{tuple(tensor.shape)}|".encode())
+                h.update(tensor.view(-1).view(torch.uint8).numpy().tobytes())
+            delta.id = h.hexdigest()
+        return delta.id
+
+    def versions(self, modified_layers: Dict[str, Dict[int, List[WeightDelta]]]) -> Dict[str, Dict[int, List[str]]]:
+        return {kind: {layer: [self.delta_id(delta) for delta in deltas] for layer, deltas in layers.items()} for kind, layers in modified_layers.items()}
+
+    def save(self, modified_layers: Dict[str, Dict[int, List[WeightDelta]]], label: str = None) -> int:
+        root = self.root
+        for layers in modified_layers.values():
+            for deltas in layers.values():
+                for delta in deltas:
+                    path = root / 'deltas' / f"{self.delta_id(delta)}.safetensors"
+                    if not path.exists():
+                        save_file({k: v.detach().to('cpu').contiguous() for k, v in delta.pack().items()}, path)
+        ids = self.ids()
+        checkpoint_id = ids[-1] + 1 if ids else 0
+        manifest = {
+            'id': checkpoint_id,
+            'label': label,
+            'created': time.time(),
+            'layers': {kind: {str(layer): ids for layer, ids in layers.items()} for kind, layers in self.versions(modified_layers).items()}
+        }
+        with open(root / 'checkpoints' / f"{checkpoint_id}.json", 'w') as f:
+            json.dump(manifest, f)
+        return checkpoint_id
+
+    def manifest(self, checkpoint_id: int) -> Dict:
+        path = self.root / 'checkpoints' / f"{checkpoint_id}.json"
+        if not path.exists():
+            raise KeyError(f"No checkpoint {checkpoint_id}")
+        with open(path) as f:
+            manifest = json.load(f)
+        manifest['layers'] = {kind: {int(layer): ids for layer, ids in layers.items()} for kind, layers in manifest['layers'].items()}
+        return manifest
+
+    def list(self) -> List[Dict]:
+        summaries = []
+        for checkpoint_id in self.ids():
+            manifest = self.manifest(checkpoint_id)
+            summaries.append({
+                'id': checkpoint_id,
+                'label': manifest['label'],
+                'created': manifest['created'],
+                'matrices': sum(len(layers) for layers in manifest['layers'].values())
+            })
+        return summaries
+
+    def load_delta(self, delta_id: str) -> WeightDelta:
+        delta = WeightDelta.unpack(load_file(self.root / 'deltas' / f"{delta_id}.safetensors"))
+        delta.id = delta_id
+        return delta
+
+    def export(self, dirname: str):
+        # a copy of the whole store, file by file, that `extend` can read back
+        shutil.rmtree(dirname, ignore_errors=True)
+        shutil.copytree(self.root, dirname)
+
+    def extend(self, other: 'CheckpointStore'):
+        # appends `other`'s checkpoints under new ids, copying their delta files rather than loading them
+        root = self.root
+        for checkpoint_id in other.ids():
+            with open(other.root / 'checkpoints' / f"{checkpoint_id}.json") as f:
+                manifest = json.load(f)
+            for layers in manifest['layers'].values():
+                for ids in layers.values():
+                    for delta_id in ids:
+                        path = root / 'deltas' / f"{delta_id}.safetensors"
+                        if not path.exists():
+                            shutil.copyfile(other.root / 'deltas' / f"{delta_id}.safetensors", path)
+            ids = self.ids()
+            manifest['id'] = ids[-1] + 1 if ids else 0
+            with open(root / 'checkpoints' / f"{manifest['id']}.json", 'w') as f:
+                json.dump(manifest, f)
+
+    def load(self, checkpoint_id: int) -> Dict[str, Dict[int, List[WeightDelta]]]:
+        layers = self.manifest(checkpoint_id)['layers']
+        return {kind: {layer: [self.load_delta(i) for i in ids] for layer, ids in layers.get(kind, {}).items()} for kind in ('mlp', 'W_O')}
+
+    @staticmethod
+    def diff_versions(a: Dict[str, Dict[int, List[str]]], b: Dict[str, Dict[int, List[str]]]) -> Dict[str, List[int]]:
+        # matrices whose delta chains differ
+        return {kind: sorted(layer for layer in set(a.get(kind, {})) | set(b.get(kind, {})) if a.get(kind, {}).get(layer, []) != b.get(kind, {}).get(layer, [])) for kind in ('mlp', 'W_O')}
+
+    def __len__(self):
+        return len(self.ids())
+
+class OriginalWeights(Mapping):
+    """Pristine copies of the model's weights, spilled to disk the first time each one is about to change.
+
+    Nothing is written until an entry's first edit (`keep`), so startup costs nothing and the spill grows with what was
+    actually modified: W_O/W_out as `layer_attn`/`layer_mlp` edit them, and whatever a loaded state dict overwrites
+    (`keep_changed`). An entry that was never spilled is still pristine in the model and is read (and spilled) from
+    there. Each spilled entry is its own safetensors file, read back through a memory map. Files go to `root`, or a
+    temporary directory (under `parent` if given) that is removed with this object.
+    """
+    def __init__(self, model: HookedTransformer, root: str = None, parent: str = None):
+        self.model = model
+        self._root = Path(root) if root else None
+        self.parent = parent
+        self.files = {}
+
+    @property
+    def root(self) -> Path:
+        if self._root is None:
+            if self.parent is not None:
+                Path(self.parent).mkdir(parents=True, exist_ok=True)
+            self._root = Path(tempfile.mkdtemp(prefix='abliterator-original-', dir=self.parent))
+            weakref.finalize(self, shutil.rmtree, self._root, True)
+        self._root.mkdir(parents=True, exist_ok=True)
+        return self._root
+
+    def keep(self, name: str):
+        # call before the named parameter (or buffer) is first replaced
+        if name not in self.files:
+            try:
+                tensor = self.model.get_parameter(name)
+            except AttributeError:
+                tensor = self.model.get_buffer(name)
+            path = self.root / f"{name}.safetensors"
+            save_file({name: tensor.detach().to('cpu').contiguous()}, path)
+            self.files[name] = path
+
+    def keep_changed(self, state_dict: Dict[str, Tensor]) -> List[str]:
+        # for changes that bypass `layer_attn`/`layer_mlp`: spills every entry `state_dict` would overwrite with a
+        # different value, and returns their names
+        current = self.model.state_dict()
+        changed = [
+            name for name, value in state_dict.items()
+            if name in current and not torch.equal(current[name], value.to(current[name].device, current[name].dtype))
+        ]
+        for name in changed:
+            self.keep(name)
+        return changed
+
+    def __getitem__(self, name: str) -> Tensor:
+        self.keep(name)
+        with safe_open(self.files[name], framework='pt', device='cpu') as f:
+            return f.get_tensor(name)
+
+    def __iter__(self):
+        return iter(list(self.files))
+
+    def __len__(self):
+        return len(self.files)
+
+def restore_checkpoint(ablator, store: CheckpointStore, checkpoint_id: int) -> Dict[str, List[int]]:
+    # Rebuilds, from the original weights, only the matrices whose deltas differ from the checkpoint's; returns those
+    target = store.manifest(checkpoint_id)['layers']
+    changed = store.diff_versions(store.versions(ablator.modified_layers), target)
+    for kind, layers in changed.items():
+        for layer in layers:
+            ids = target.get(kind, {}).get(layer)
+            if ids:
+                ablator.modified_layers[kind][layer] = [store.load_delta(i) for i in ids]
+            else:
+                ablator.modified_layers[kind].pop(layer, None)
+            if hasattr(ablator, 'snapshot_weight'):
+                ablator.snapshot_weight(kind, layer)
+            ablator.model.get_parameter(MODIFIABLE_WEIGHTS[kind].format(layer)).data = ablator.replay_modifications(kind, layer)
+    ablator.modified = any(ablator.modified_layers[kind] for kind in ablator.modified_layers)
+    return changed
+
+class ActivationAccumulator:
+    # Host-side reduction of per-batch activations: collected rows, RunningStats when streaming,
+    # or CompactActivations when `compact` names a storage format
+    def __init__(self, streaming: bool = False, covariance: bool = False, compact: str = None):
+        if streaming and compact:
+            raise ValueError("Streaming keeps no per-prompt rows to store compactly")
+        self.streaming = streaming
+        self.covariance = covariance
+        self.compact = compact
+        self.base = {}
+
+    def __call__(self, tensors: Dict[str, Float[Tensor, 'batch_size d_model']]):
+        for key, tensor in tensors.items():
+            if self.streaming:
+                if key not in self.base:
+                    self.base[key] = RunningStats(covariance=self.covariance)
+                self.base[key].update(tensor)
+            elif self.compact:
+                if key not in self.base:
+                    self.base[key] = CompactActivations(self.compact)
+                self.base[key].update(tensor)
+            else:
+                # pinned buffers get reused by the offloader, so keep a copy of those
+                self.base.setdefault(key, []).append(tensor.clone() if tensor.is_pinned() else tensor)
+
+    def result(self, perm: Int[Tensor, 'n'] = None) -> Dict[str, Tensor|RunningStats]:
+        if self.streaming:
+            return {key: stats.to('cpu') for key, stats in self.base.items()}
+        if self.compact:
+            return {key: acts.reorder(perm) if perm is not None else acts for key, acts in self.base.items()}
+        # a single concatenation at the end instead of growing every key batch by batch
+        rows = {key: torch.cat(chunks, dim=0) for key, chunks in self.base.items()}
+        if perm is not None:
+            rows = {key: tensor[perm] for key, tensor in rows.items()}
+        return rows
+
+class ActivationOffloader:
+    """Double-buffered device-to-host pipeline for per-batch activations.
+
+    CUDA tensors are copied into reusable pinned host buffers on a side stream, and a background
+    thread waits for each copy before handing the host tensors to `sink`. The next batch's forward
+    overlaps the previous batch's transfer and reduction; CPU tensors go straight to the thread.
+    """
+    def __init__(self, sink: Callable[[Dict[str, Tensor]], None], depth: int = 2):
+        self.sink = sink
+        self.depth = depth
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = deque()
+        self.buffers = [{} for _ in range(depth)]
+        self.streams = {}
+        self.slot = 0
+
+    def host_buffer(self, key: str, tensor: Tensor) -> Tensor:
+        buf = self.buffers[self.slot].get(key)
+        if buf is None or buf.shape[0] < tensor.shape[0] or buf.shape[1:] != tensor.shape[1:] or buf.dtype != tensor.dtype:
+            buf = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+            self.buffers[self.slot][key] = buf
+        return buf[:tensor.shape[0]]
+
+    def submit(self, tensors: Dict[str, Tensor]):
+        if len(self.pending) >= self.depth:
+            # the oldest batch still owns the buffers we're about to reuse (and may have raised)
+            self.pending.popleft().result()
+
+        host, events = {}, []
+        on_device = {}
+        for key, tensor in tensors.items():
+            if tensor.is_cuda:
+                on_device.setdefault(tensor.device, []).append(key)
+            else:
+                host[key] = tensor
+        for device, keys in on_device.items():
+            if device not in self.streams:
+                self.streams[device] = torch.cuda.Stream(device=device)
+            stream = self.streams[device]
+            stream.wait_stream(torch.cuda.current_stream(device))
+            with torch.cuda.stream(stream):
+                for key in keys:
+                    # keep the allocator from handing this memory to the next forward before the copy lands
+                    tensors[key].record_stream(stream)
+                    host[key] = self.host_buffer(key, tensors[key]).copy_(tensors[key], non_blocking=True)
+                event = torch.cuda.Event()
+                event.record(stream)
+            events.append(event)
+
+        self.slot = (self.slot + 1) % self.depth
+        self.pending.append(self.executor.submit(self.drain, host, events))
+
+    def drain(self, host: Dict[str, Tensor], events: List):
+        for event in events:
+            event.synchronize()
+        self.sink(host)
+
+    def close(self):
+        try:
+            while self.pending:
+                self.pending.popleft().result()
+        finally:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+
+class TokenizationCache:
+    """Unpadded token ids of templated instructions, keyed by (template, instruction).
+
+    Only instructions not seen before under the current template reach the tokenizer, in one batched call;
+    padded batches are assembled from the stored ids on demand. Ids are kept as int32 tensors, and only the
+    `max_entries` most recently used instructions stay cached.
+    """
+    def __init__(self, tokenizer, max_entries: int = 65536):
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def key(chat_template) -> str:
+        # a plain format string works as a chat template too
+        return getattr(chat_template, 'template', chat_template)
+
+    def ids(self, chat_template, instructions: List[str]) -> List[Int[Tensor, 'seq_len']]:
+        template = self.key(chat_template)
+        found = {}
+        for instruction in instructions:
+            if (template, instruction) in self.entries:
+                self.entries.move_to_end((template, instruction))
+                found[instruction] = self.entries[(template, instruction)]
+        missing = list(dict.fromkeys(instruction for instruction in instructions if instruction not in found))
+        if missing:
+            prompts = [chat_template.format(instruction=instruction) for instruction in missing]
+            for instruction, row in zip(missing, self.tokenizer(prompts, padding=False, truncation=False).input_ids):
+                found[instruction] = self.entries[(template, instruction)] = torch.tensor(row, dtype=torch.int32)
+        # the result is built from `found`, so a call larger than the cap still gets all its ids
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return [found[instruction] for instruction in instructions]
+
+    def batch(self, chat_template, instructions: List[str]) -> Int[Tensor, 'batch_size seq_len']:
+        return left_pad(self.ids(chat_template, instructions), self.tokenizer.pad_token_id)
+
+    def clear(self, chat_template=None):
+        if chat_template is None:
+            self.entries.clear()
+        else:
+            template = self.key(chat_template)
+            for key in [key for key in self.entries if key[0] == template]:
+                del self.entries[key]
+
+class TokenizedDataset:
+    """Templated instructions tokenized ahead of time: a flat int32 token file plus int64 row offsets.
+
+    `build` tokenizes with batched calls to the fast tokenizer, which parallelize internally, appending each chunk to disk;
+    `open` maps both files with `torch.from_file`, so rows (int32 tensor views) are only read when used.
+    """
+    def __init__(self, tokens: Int[Tensor, 'n_tokens'], offsets: Int[Tensor, 'n_rows_plus_one'], template: str = None, digest: str = None):
+        self.tokens = tokens
+        self.offsets = offsets
+        self.template = template
+        # `instructions_digest` of the rows; a slice keeps it, since it describes the files it was cut from
+        self.digest = digest
+
+    @staticmethod
+    def instructions_digest(instructions: List[str]) -> str:
+        return hashlib.sha256(json.dumps(list(instructions)).encode()).hexdigest()
+
+    def matches(self, chat_template, instructions: List[str]) -> bool:
+        # True if these rows are `instructions` tokenized under `chat_template`
+        return self.template == TokenizationCache.key(chat_template) and len(self) == len(instructions) and self.digest == TokenizedDataset.instructions_digest(instructions)
+
+    @classmethod
+    def build(cls, tokenizer, chat_template, instructions: List[str], path: str, chunk_size: int = 65536) -> 'TokenizedDataset':
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        offsets = [0]
+        with open(path / 'tokens.int32', 'wb') as f:
+            # one batched call per chunk: the Rust backend already spreads a batch over its own threads, and a shared
+            # tokenizer isn't safe to call from several Python threads; chunks only bound the ids held in memory
+            for chunk in batch(instructions, chunk_size):
+                ids = tokenizer([chat_template.format(instruction=instruction) for instruction in chunk], padding=False, truncation=False).input_ids
+                for row in ids:
+                    offsets.append(offsets[-1] + len(row))
+                f.write(torch.tensor([t for row in ids for t in row], dtype=torch.int32).numpy().tobytes())
+        torch.tensor(offsets, dtype=torch.int64).numpy().tofile(path / 'offsets.int64')
+        with open(path / 'meta.json', 'w') as f:
+            json.dump({'template': TokenizationCache.key(chat_template), 'rows': len(offsets) - 1, 'tokens': offsets[-1], 'digest': cls.instructions_digest(instructions)}, f)
+        return cls.open(path)
+
+    @classmethod
+    def open(cls, path: str) -> 'TokenizedDataset':
+        path = Path(path)
+        with open(path / 'meta.json') as f:
+            meta = json.load(f)
+        tokens = torch.from_file(str(path / 'tokens.int32'), size=meta['tokens'], dtype=torch.int32) if meta['tokens'] else torch.empty(0, dtype=torch.int32)
+        offsets = torch.from_file(str(path / 'offsets.int64'), size=meta['rows'] + 1, dtype=torch.int64)
+        return cls(tokens, offsets, meta['template'], meta.get('digest'))
+
+    def lengths(self) -> List[int]:
+        return (self.offsets[1:] - self.offsets[:-1]).tolist()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                raise ValueError("TokenizedDataset slices must be contiguous")
+            return TokenizedDataset(self.tokens, self.offsets[start:max(start, stop) + 1], self.template, self.digest)
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
 class ChatTemplate:
     def __init__(self,model,template):
         self.model = model
@@ -103,6 +1411,10 @@ class ChatTemplate:
 
     def __exit__(self,exc,exc_value,exc_tb):
         self.model.chat_template = self.prev
+        # ids tokenized under this (temporary) template go with it
+        token_cache = getattr(self.model, 'token_cache', None)
+        if token_cache is not None and TokenizationCache.key(self.prev) != self.template:
+            token_cache.clear(self)
         del self.prev
 
 class ModelPathManager:
@@ -127,8 +1439,23 @@ class ModelPathManager:
         
         return sorted(safetensor_files)
         
+    @staticmethod
+    def link_file(source: Path, target: Path):
+        """Make `target` refer to `source`: a hardlink, else a symlink, copying only if neither is possible"""
+        if target.exists() or target.is_symlink():
+            if target.exists() and os.path.samefile(source, target):
+                return
+            target.unlink()
+        try:
+            os.link(source, target)
+        except OSError:
+            try:
+                os.symlink(source.resolve(), target)
+            except OSError:
+                shutil.copy2(source, target)
+
     def save_model(self, model_path: Union[str, Path], save_name: Optional[str] = None) -> str:
-        """Save model files to models directory with proper naming"""
+        """Register model files in the models directory with proper naming, by reference rather than by copy"""
         source_path = Path(model_path)
         if source_path.is_file():
             source_path = source_path.parent
@@ -139,13 +1466,14 @@ class ModelPathManager:
         save_dir = self.base_dir / save_name
         save_dir.mkdir(parents=True, exist_ok=True)
         
-        # Copy all safetensor files to new directory
+        # Link all safetensor files into the new directory
         for file in self.get_model_files(source_path):
-            shutil.copy2(file, save_dir / file.name)
+            self.link_file(file, save_dir / file.name)
         
-        # Copy any config files
-        for config_file in source_path.glob("config.*"):
-            shutil.copy2(config_file, save_dir / config_file.name)
+        # Link the rest (configs, shard index, tokenizer files) so the directory loads on its own
+        for other_file in source_path.iterdir():
+            if other_file.is_file() and other_file.suffix != ".safetensors":
+                self.link_file(other_file, save_dir / other_file.name)
             
         return str(save_dir)
     
@@ -164,8 +1492,22 @@ class ModelAbliterator:
         chat_template: str = None,
         positive_toks: List[int]|Tuple[int]|Set[int]|Int[Tensor, '...'] = None,
         negative_toks: List[int]|Tuple[int]|Set[int]|Int[Tensor, '...'] = None,
-        model_dir: str = "models"
+        model_dir: str = "models",
+        activation_cache_dir: str = None,
+        activation_cache_budget: int = 8 * 2**30,
+        checkpoint_dir: str = None,
+        original_state_dir: str = None,
+        architecture: str = None
     ):
+        # seconds spent in each startup phase, in order
+        self.startup_timings = {}
+        start = time.perf_counter()
+        def phase(name):
+            nonlocal start
+            now = time.perf_counter()
+            self.startup_timings[name] = now - start
+            start = now
+
         self.path_manager = ModelPathManager(model_dir)
         
         # Handle local file paths and HuggingFace model IDs
@@ -182,6 +1524,7 @@ class ModelAbliterator:
             # Assume it's a HuggingFace model ID
             self.MODEL_PATH = model
             self.model_files = None
+        phase('register')
             
         if n_devices is None and torch.cuda.is_available():
             n_devices = torch.cuda.device_count()
@@ -193,15 +1536,28 @@ class ModelAbliterator:
 
         # Load model
         if self.model_files:
-            # Load from safetensor files
+            # TransformerLens only knows official model names: the local weights are loaded through HF and handed over
+            # under the name of their architecture, whose config TransformerLens still reads from the Hub (or the HF cache).
+            # `architecture` is the official name the weights fit (e.g. the model they were fine-tuned from); without it,
+            # the `_name_or_path` in the local config.json is tried
+            if architecture is None:
+                config_path = Path(self.MODEL_PATH) / "config.json"
+                architecture = json.loads(config_path.read_text()).get('_name_or_path') if config_path.exists() else None
+            try:
+                architecture = loading.get_official_model_name(architecture or str(self.MODEL_PATH))
+            except ValueError:
+                raise ValueError(f"Can't tell which architecture {self.MODEL_PATH} is; pass `architecture=` with its official TransformerLens model name") from None
+            hf_model = AutoModelForCausalLM.from_pretrained(self.MODEL_PATH, torch_dtype=torch.bfloat16)
             self.model = HookedTransformer.from_pretrained_no_processing(
-                self.MODEL_PATH,
+                architecture,
+                hf_model=hf_model,
+                tokenizer=AutoTokenizer.from_pretrained(self.MODEL_PATH),
                 device=device,
                 n_devices=n_devices,
                 dtype=torch.bfloat16,
-                default_padding_side='left',
-                model_files=self.model_files  # Pass the list of model files
+                default_padding_side='left'
             )
+            del hf_model
         else:
             # Load from HuggingFace
             self.model = HookedTransformer.from_pretrained_no_processing(
@@ -212,35 +1568,48 @@ class ModelAbliterator:
                 default_padding_side='left'
             )
 
-        # Save memory
-        torch.set_grad_enabled(False)
-
-        self.model = HookedTransformer.from_pretrained_no_processing(
-            model,
-            n_devices=n_devices,
-            device=device,
-            dtype=torch.bfloat16,
-            default_padding_side='left'
-        )
-
         self.model.requires_grad_(False)
+        phase('load')
 
         self.model.tokenizer.padding_side = 'left'
         self.model.tokenizer.pad_token = self.model.tokenizer.eos_token
         self.chat_template = chat_template or ChatTemplate(self,LLAMA3_CHAT_TEMPLATE)
+        # token ids per (template, instruction), so repeated slices of the datasets aren't re-tokenized
+        self.token_cache = TokenizationCache(self.model.tokenizer)
 
         self.hidden_size = self.model.cfg.d_model
-        self.original_state = {k:v.to('cpu') for k,v in self.model.state_dict().items()}
+        # the unmodified W_O/W_out, spilled next to the models directory as they're first edited
+        self.original_state = OriginalWeights(self.model, original_state_dir, self.path_manager.base_dir)
+        phase('original_state')
         self.harmful = {}
         self.harmless = {}
         self.modified_layers = {'mlp':{}, 'W_O':{}}
-        self.checkpoints = []
+        # checkpoints live on disk (a temporary directory unless `checkpoint_dir` is given)
+        self.checkpoints = CheckpointStore(checkpoint_dir)
+        # open `with self:` contexts, innermost last
+        self._snapshots = []
+        # instructions behind the current harmful/harmless caches, in cache order; lets `cache_activations(append=True)` skip them
+        self.cached_prompts = None
+        # training sets tokenized to disk by `pretokenize`, if it was run
+        self.pretokenized = None
 
         if cache_fname is not None:
-            outs = torch.load(cache_fname,map_location='cpu')
-            self.harmful,self.harmless,modified_layers,checkpoints = outs[:4]
-            self.checkpoints = checkpoints or []
-            self.modified_layers = modified_layers
+            if os.path.isdir(cache_fname):
+                # sharded store: activations stay on disk until a key is asked for
+                groups,state = load_activation_store(cache_fname)
+                self.harmful,self.harmless = groups['harmful'],groups['harmless']
+                modified_layers,checkpoints = state.get('modified_layers'),state.get('checkpoints')
+                self.cached_prompts = state.get('cached_prompts')
+                if state.get('checkpoint_store'):
+                    self.checkpoints.extend(CheckpointStore(os.path.join(cache_fname,state['checkpoint_store'])))
+            else:
+                # legacy single-file pickle
+                outs = torch.load(cache_fname,map_location='cpu')
+                self.harmful,self.harmless,modified_layers,checkpoints = outs[:4]
+            for c in checkpoints or []:
+                self.checkpoints.save(unpack_modified_layers(c))
+            self.modified_layers = unpack_modified_layers(modified_layers)
+            phase('activation_cache')
 
         self.harmful_inst_train,self.harmful_inst_test = prepare_dataset(dataset[0])
         self.harmless_inst_train,self.harmless_inst_test = prepare_dataset(dataset[1])
@@ -259,31 +1628,63 @@ class ModelAbliterator:
         else:
             self.positive_toks = positive_toks
         self._blacklisted = set()
+        # batch sizes picked under a memory budget, per operation, so runs can be reproduced
+        self.batch_sizes = {}
+        # generation throughput (tokens/s) of the last continuously batched run, per operation
+        self.throughput = {}
+        # persistent per-prompt activations, shared across runs on the same model weights and template
+        self.activation_disk_cache = ActivationDiskCache(activation_cache_dir, activation_cache_budget) if activation_cache_dir else None
+        phase('setup')
 
     def __enter__(self):
-        if hasattr(self,"current_state"):
-            raise Exception("Cannot do multi-contexting")
-        self.current_state = self.model.state_dict()
-        self.current_layers = self.modified_layers.copy()
-        self.was_modified = self.modified
+        # copy-on-write: a matrix is only remembered (by reference, edits replace `.data`) the first time
+        # `layer_attn`/`layer_mlp` touch it inside the block, and only those are put back on exit; contexts nest
+        self._snapshots.append({
+            'weights': {},
+            'modified_layers': copy_modified_layers(self.modified_layers),
+            'modified': self.modified
+        })
         return self
 
     def __exit__(self,exc,exc_value,exc_tb):
-        self.model.load_state_dict(self.current_state)
-        del self.current_state
-        self.modified_layers = self.current_layers
-        del self.current_layers
-        self.modified = self.was_modified
-        del self.was_modified
+        snapshot = self._snapshots.pop()
+        for name,tensor in snapshot['weights'].items():
+            self.model.get_parameter(name).data = tensor
+        self.modified_layers = snapshot['modified_layers']
+        self.modified = snapshot['modified']
+
+    def snapshot_weight(self, kind: str, layer: int):
+        # called before a matrix is replaced, so every open context can restore it
+        name = MODIFIABLE_WEIGHTS[kind].format(layer)
+        for snapshot in self._snapshots:
+            if name not in snapshot['weights']:
+                snapshot['weights'][name] = self.model.get_parameter(name).data
 
     def reset_state(self):
+        # only the modified matrices are read back; `.data` is swapped rather than copied into, which open contexts rely on
+        for kind,layers in self.modified_layers.items():
+            for layer in layers:
+                self.snapshot_weight(kind,layer)
+                param = self.model.get_parameter(MODIFIABLE_WEIGHTS[kind].format(layer))
+                param.data = self.original_state[MODIFIABLE_WEIGHTS[kind].format(layer)].to(param.device, param.dtype)
         self.modified = False
         self.modified_layers = {'mlp':{}, 'W_O':{}}
-        self.model.load_state_dict(self.original_state)
 
-    def checkpoint(self):
-        # MAYBE: Offload to disk? That way we're not taking up RAM with this
-        self.checkpoints.append(self.modified_layers.copy())
+    def checkpoint(self, label: str = None) -> int:
+        # written to the on-disk checkpoint store; returns the id for `restore`
+        return self.checkpoints.save(self.modified_layers, label)
+
+    def list_checkpoints(self) -> List[Dict]:
+        return self.checkpoints.list()
+
+    def restore(self, checkpoint_id: int) -> Dict[str, List[int]]:
+        # only matrices that differ from the checkpoint are rebuilt; returns them per kind
+        return restore_checkpoint(self, self.checkpoints, checkpoint_id)
+
+    def diff(self, a: int, b: int = None) -> Dict[str, List[int]]:
+        # layers whose edits differ between checkpoints `a` and `b` (the current state if `b` is None)
+        store = self.checkpoints
+        return store.diff_versions(store.manifest(a)['layers'], store.versions(self.modified_layers) if b is None else store.manifest(b)['layers'])
 
     # Utility functions
 
@@ -304,7 +1705,15 @@ class ModelAbliterator:
             self._blacklisted.discard(layer)
 
     def save_activations(self, fname: str):
-        torch.save([self.harmful,self.harmless,self.modified_layers if self.modified_layers['mlp'] or self.modified_layers['W_O'] else None, self.checkpoints if len(self.checkpoints) > 0 else None], fname)
+        # `fname` becomes a directory: one shard per hook name plus a manifest, reopened lazily via `cache_fname`;
+        # checkpoints are copied over as files, never loaded
+        if len(self.checkpoints) > 0:
+            self.checkpoints.export(os.path.join(fname,ACTIVATION_STORE_CHECKPOINTS))
+        save_activation_store(fname, {'harmful':self.harmful, 'harmless':self.harmless}, {
+            'modified_layers': pack_modified_layers(self.modified_layers) if self.modified_layers['mlp'] or self.modified_layers['W_O'] else None,
+            'checkpoint_store': ACTIVATION_STORE_CHECKPOINTS if len(self.checkpoints) > 0 else None,
+            'cached_prompts': getattr(self,'cached_prompts',None)
+        })
 
     def get_whitelisted_layers(self) -> List[int]:
         return [l for l in range(self.model.cfg.n_layers) if l not in self._blacklisted]
@@ -312,20 +1721,83 @@ class ModelAbliterator:
     def get_all_act_names(self, activation_layers: List[str] = None) -> List[Tuple[int,str]]:
         return [(i,utils.get_act_name(act_name,i)) for i in self.get_whitelisted_layers() for act_name in (activation_layers or self.activation_layers)]
 
+    def get_cache_stop_layer(self, activation_layers: List[str] = None) -> int|None:
+        # deepest block any whitelisted act name lives in; later blocks and the unembedding never need to run
+        if (activation_layers or self.activation_layers) is None:
+            return None
+        layers = [ln for ln,act_name in self.get_all_act_names(activation_layers)]
+        return max(layers)+1 if layers else None
+
+    def model_fingerprint(self) -> str:
+        # identity of the loaded (unmodified) weights: config plus, for every parameter, its product with a fixed random
+        # vector. A change anywhere in a matrix (e.g. a middle layer's abliterated W_O) changes that product, at the cost
+        # of one matrix-vector product per parameter, computed once
+        if getattr(self,'_fingerprint',None) is None:
+            h = hashlib.sha256(f"{self.model.cfg.model_name}|{self.model.cfg.n_layers}|{self.model.cfg.d_model}|{self.model.cfg.d_vocab}|{self.model.cfg.dtype}".encode())
+            probes = {}
+            for name,param in self.model.named_parameters():
+                rows = param.detach().reshape(-1, param.shape[-1])
+                if rows.shape[1] not in probes:
+                    probes[rows.shape[1]] = torch.randn(rows.shape[1], generator=torch.Generator().manual_seed(rows.shape[1]), dtype=torch.float64)
+                h.update(name.encode())
+                probe = probes[rows.shape[1]].to(rows.device)
+                # a few rows at a time, so the fp64 copy stays small even for the embeddings
+                for chunk in rows.split(1024):
+                    h.update((chunk.double() @ probe).cpu().numpy().tobytes())
+            self._fingerprint = h.hexdigest()
+        return self._fingerprint
+
+    def get_cached_hook_names(self, stop_at_layer: int = None) -> List[str]:
+        # names `run_with_cache` will fill for the current activation layers when stopping at `stop_at_layer`
+        return [name for name in self.model.hook_dict
+                if any(s in name for s in self.activation_layers)
+                and self.get_layer_of_act_name(name) is not None
+                and (stop_at_layer is None or self.get_layer_of_act_name(name) < stop_at_layer)]
+
+    def cached_activation_batch(
+        self,
+        plan: BatchPlan,
+        indices: List[int],
+        last_indices: int = 1,
+        stop_at_layer: int = None
+    ) -> Dict[str, Float[Tensor, 'batch_size d_model']]:
+        # Serve rows from the disk cache, and only run the forward for prompts that missed
+        disk = self.activation_disk_cache
+        names = self.get_cached_hook_names(stop_at_layer)
+        template = getattr(self.chat_template,'template',self.chat_template)
+        keys = [disk.key(self.model_fingerprint(), template, plan.prompts[i], last_indices) for i in indices]
+        rows = [disk.get(key,names) for key in keys]
+
+        missing = [pos for pos,row in enumerate(rows) if row is None]
+        if missing:
+            logits,cache = self.run_with_cache(plan.pad([indices[pos] for pos in missing]),max_new_tokens=0,reduce_last=last_indices,stop_at_layer=stop_at_layer)
+            for row_idx,pos in enumerate(missing):
+                rows[pos] = {name:cache[name][row_idx].to('cpu') for name in names}
+                disk.put(keys[pos],rows[pos])
+            del logits,cache
+
+        return {name:torch.stack([row[name] for row in rows]) for name in names}
+
     def calculate_mean_dirs(self, key: str, include_overall_mean: bool = False) -> Dict[str, Float[Tensor, 'd_model']]:
+        # read each side once; with a sharded activation store every access is a read from disk
+        harmful_acts = self.harmful[key]
+        harmless_acts = self.harmless[key]
         dirs = {
-            'harmful_mean': torch.mean(self.harmful[key], dim=0),
-            'harmless_mean': torch.mean(self.harmless[key], dim=0)
+            'harmful_mean': activation_mean(harmful_acts),
+            'harmless_mean': activation_mean(harmless_acts)
         }
 
         if include_overall_mean:
-            if self.harmful[key].shape != self.harmless[key].shape or self.harmful[key].device.type == 'cuda':
+            if not isinstance(harmful_acts, Tensor) or not isinstance(harmless_acts, Tensor):
+                # Streamed and compact caches already have their means, so combine those weighted by prompt count
+                dirs['mean_dir'] = (dirs['harmful_mean'] * len(harmful_acts) + dirs['harmless_mean'].to(dirs['harmful_mean'].device) * len(harmless_acts)) / (len(harmful_acts) + len(harmless_acts))
+            elif harmful_acts.shape != harmless_acts.shape or harmful_acts.device.type == 'cuda':
                 # If the shapes are different, we can't add them together; we'll need to concatenate the tensors first.
                 # Using 'cpu', this is slower than the alternative below.
                 # Using 'cuda', this seems to be faster than the alternatives.
                 # NOTE: Assume both tensors are on the same device.
                 #
-                dirs['mean_dir'] = torch.mean(torch.cat((self.harmful[key], self.harmless[key]), dim=0), dim=0)
+                dirs['mean_dir'] = torch.mean(torch.cat((harmful_acts, harmless_acts), dim=0), dim=0)
             else:
                 # If the shapes are the same, we can add them together, take the mean,
                 # then divide by 2.0 to account for the initial element-wise addition of the tensors.
@@ -333,7 +1805,7 @@ class ModelAbliterator:
                 # The result is identical to:
                 #    `torch.sum(self.harmful[key] + self.harmless[key]) / (len(self.harmful[key]) + len(self.harmless[key]))`
                 #
-                dirs['mean_dir'] =  torch.mean(self.harmful[key] + self.harmless[key], dim=0) / 2.0
+                dirs['mean_dir'] =  torch.mean(harmful_acts + harmless_acts, dim=0) / 2.0
 
         return dirs
 
@@ -347,48 +1819,130 @@ class ModelAbliterator:
             raise IndexError("Invalid layer")
         return self.calculate_mean_dirs(utils.get_act_name(act_key, layer), include_overall_mean=include_overall_mean)
 
-    def refusal_dirs(self, invert: bool = False) -> Dict[str, Float[Tensor, 'd_model']]:
+    def refusal_dirs(self, invert: bool = False) -> DirectionBank:
         if not self.harmful:
             raise IndexError("No cache")
 
-        refusal_dirs = {key:self.calculate_mean_dirs(key) for key in self.harmful if '.0.' not in key} # don't include layer 0, as it often becomes NaN
+        keys = direction_keys(self.harmful.keys())
+        if not keys:
+            raise ValueError("No refusal directions: only layer 0 is cached, whose direction is left out")
+        harmful_means = torch.stack([activation_mean(self.harmful[key]).to('cpu', torch.float32) for key in keys])
+        harmless_means = torch.stack([activation_mean(self.harmless[key]).to('cpu', torch.float32) for key in keys])
         if invert:
-            refusal_dirs = {key:v['harmless_mean']-v['harmful_mean'] for key,v in refusal_dirs.items()}
-        else:
-            refusal_dirs = {key:v['harmful_mean']-v['harmless_mean'] for key,v in refusal_dirs.items()}
-
-        return {key:(v/v.norm()).to('cpu') for key,v in refusal_dirs.items()}
-
-    def scored_dirs(self,invert = False) -> List[Tuple[str,Float[Tensor, 'd_model']]]:
+            return DirectionBank.from_means(keys, harmless_means, harmful_means)
+        return DirectionBank.from_means(keys, harmful_means, harmless_means)
+
+    def refusal_dir_error_bounds(self) -> Dict[str, float]:
+        # how far each of `refusal_dirs()` can be from the one full-precision activations would give (0 unless compact)
+        bounds = {}
+        for key in direction_keys(self.harmful.keys()):
+            harmful_acts, harmless_acts = self.harmful[key], self.harmless[key]
+            direction = activation_mean(harmful_acts) - activation_mean(harmless_acts)
+            bounds[key] = direction_error_bound(harmful_acts, harmless_acts, direction)
+        return bounds
+
+    def separation_scores(self, invert: bool = False, refusal_dirs: DirectionBank = None, chunk_size: int = 32) -> Dict[str, Float[Tensor, 'n_dirs']]:
+        # Generation-free ranking signal: cached harmful and harmless rows projected onto their key's direction, one batched
+        # matmul per `chunk_size` keys, scored by AUC, Cohen's d and margin. Aligned with `refusal_dirs.names`; higher is better
+        dirs = refusal_dirs if refusal_dirs is not None else self.refusal_dirs(invert=invert)
+        if len(dirs) == 0:
+            raise ValueError("No refusal directions to score")
+        projections = {'harmful': [], 'harmless': []}
+        for start in range(0, len(dirs), chunk_size):
+            names = dirs.names[start:start+chunk_size]
+            directions = dirs.directions[start:start+chunk_size]
+            for group,acts in (('harmful',self.harmful), ('harmless',self.harmless)):
+                rows = torch.stack([activation_rows(acts[name]).to('cpu', torch.float32) for name in names])
+                projections[group].append(torch.einsum('k n d, k d -> k n', rows, directions))
+        harmful, harmless = torch.cat(projections['harmful']), torch.cat(projections['harmless'])
+        return separation_metrics(harmless, harmful) if invert else separation_metrics(harmful, harmless)
+
+    def scored_dirs(self, invert: bool = False, metric: str = None) -> List[Tuple[str,Float[Tensor, 'd_model']]]:
+        # whitelisted directions, best first, paired with their layer; ranked by a `separation_scores()` metric
+        # (Cohen's d by default) or, with metric='mean', by the size of the direction's mean component as streamed caches need
         refusals = self.refusal_dirs(invert=invert)
-        return sorted([(ln,refusals[act_name]) for ln,act_name in self.get_all_act_names()],reverse=True, key=lambda x:abs(x[1].mean()))
+        if metric is None:
+            metric = 'mean' if isinstance(self.harmful[refusals.names[0]], RunningStats) else 'cohens_d'
+        scores = None if metric == 'mean' else self.separation_scores(invert=invert,refusal_dirs=refusals)[metric]
+        return [(refusals.layers[refusals.index[name]],direction) for name,direction in refusals.topk(scores=scores,names=[act_name for ln,act_name in self.get_all_act_names()])]
 
     def get_layer_of_act_name(self, ref: str) -> str|int:
         s = re.search(r"\.(\d+)\.",ref)
         return s if s is None else int(s[1])
 
-    def layer_attn(self, layer: int, replacement: Float[Tensor, "d_model"] = None) -> Float[Tensor, "d_model"]:
+    def layer_attn(self, layer: int, replacement: Float[Tensor, "d_model"] = None, delta: WeightDelta = None) -> Float[Tensor, "d_model"]:
+        # `delta` describes how `replacement` was derived and is what gets logged; without one the log keeps a full copy
         if replacement is not None and layer not in self._blacklisted:
             # make sure device doesn't change
             self.modified = True
+            self.snapshot_weight('W_O',layer)
+            self.original_state.keep(MODIFIABLE_WEIGHTS['W_O'].format(layer))
             self.model.blocks[layer].attn.W_O.data = replacement.to(self.model.blocks[layer].attn.W_O.device)
-            self.modified_layers['W_O'][layer] = self.modified_layers.get(layer,[])+[(self.model.blocks[layer].attn.W_O.data.to('cpu'),replacement.to('cpu'))]
+            self.modified_layers['W_O'].setdefault(layer,[]).append(delta or WeightDelta(dense=replacement.to('cpu')))
         return self.model.blocks[layer].attn.W_O.data
 
-    def layer_mlp(self, layer: int, replacement: Float[Tensor, "d_model"] = None) -> Float[Tensor, "d_model"]:
+    def layer_mlp(self, layer: int, replacement: Float[Tensor, "d_model"] = None, delta: WeightDelta = None) -> Float[Tensor, "d_model"]:
         if replacement is not None and layer not in self._blacklisted:
             # make sure device doesn't change
             self.modified = True
+            self.snapshot_weight('mlp',layer)
+            self.original_state.keep(MODIFIABLE_WEIGHTS['mlp'].format(layer))
             self.model.blocks[layer].mlp.W_out.data = replacement.to(self.model.blocks[layer].mlp.W_out.device)
-            self.modified_layers['mlp'][layer] = self.modified_layers.get(layer,[])+[(self.model.blocks[layer].mlp.W_out.data.to('cpu'),replacement.to('cpu'))]
+            self.modified_layers['mlp'].setdefault(layer,[]).append(delta or WeightDelta(dense=replacement.to('cpu')))
         return self.model.blocks[layer].mlp.W_out.data
 
+    def replay_modifications(self, kind: str, layer: int) -> Float[Tensor, "d_model"]:
+        # the matrix as the logged deltas make it: original weights with every delta applied in order
+        param = self.model.get_parameter(MODIFIABLE_WEIGHTS[kind].format(layer))
+        matrix = self.original_state[MODIFIABLE_WEIGHTS[kind].format(layer)].to(param.device, param.dtype)
+        for delta in self.modified_layers[kind].get(layer,[]):
+            matrix = delta.apply(matrix)
+        return matrix
+
+    def undo_modification(self, kind: str, layer: int) -> WeightDelta:
+        # drops the last logged edit of one matrix and rebuilds it from the original weights
+        delta = self.modified_layers[kind][layer].pop()
+        if not self.modified_layers[kind][layer]:
+            del self.modified_layers[kind][layer]
+        self.snapshot_weight(kind, layer)
+        self.model.get_parameter(MODIFIABLE_WEIGHTS[kind].format(layer)).data = self.replay_modifications(kind, layer)
+        self.modified = any(self.modified_layers[k] for k in self.modified_layers)
+        return delta
+
     def tokenize_instructions_fn(
         self,
         instructions: List[str]
     ) -> Int[Tensor, 'batch_size seq_len']:
-        prompts = [self.chat_template.format(instruction=instruction) for instruction in instructions]
-        return self.model.tokenizer(prompts, padding=True, truncation=False, return_tensors="pt").input_ids
+        return self.token_cache.batch(self.chat_template, instructions)
+
+    def plan_batches(
+        self,
+        instructions: List[str],
+        batch_size: int,
+        pretokenized: TokenizedDataset = None
+    ) -> BatchPlan:
+        # `pretokenized` rows (the same instructions, tokenized by `pretokenize`) are read from disk instead
+        ids = pretokenized if pretokenized is not None else self.token_cache.ids(self.chat_template, instructions)
+        return BatchPlan(ids, self.model.tokenizer.pad_token_id, batch_size, prompts=instructions)
+
+    def pretokenize(self, path: str = None) -> str:
+        # tokenizes both training sets under the current template into `path` (a temporary directory if not given),
+        # so `cache_activations` streams token ids from disk instead of tokenizing on the calling thread
+        root = Path(path) if path else Path(tempfile.mkdtemp(prefix='abliterator-tokens-'))
+        if path is None:
+            weakref.finalize(self, shutil.rmtree, root, True)
+        self.pretokenized = {
+            name: TokenizedDataset.build(self.model.tokenizer, self.chat_template, instructions, root / name)
+            for name,instructions in (('harmful',self.harmful_inst_train), ('harmless',self.harmless_inst_train))
+        }
+        return str(root)
+
+    def pretokenized_rows(self, name: str, N: int) -> TokenizedDataset:
+        # the first N pre-tokenized rows of a training set, if they're still valid for the current template and data
+        dataset = (self.pretokenized or {}).get(name)
+        if dataset is None or not dataset.matches(self.chat_template, getattr(self,f"{name}_inst_train")):
+            return None
+        return dataset[:N]
 
     def generate_logits(
         self,
@@ -399,23 +1953,49 @@ class ModelAbliterator:
         max_tokens_generated: int = 1,
         **kwargs
     ) -> Tuple[Float[Tensor, 'batch_size seq_len d_vocab'], Int[Tensor, 'batch_size seq_len']]:
-        # does most of the model magic
+        # does most of the model magic; logits cover every position fed to the model, as one full forward pass would
         all_toks = torch.zeros((toks.shape[0],toks.shape[1]+max_tokens_generated), dtype=torch.long, device=toks.device)
         all_toks[:, :toks.shape[1]] = toks
-        generating = [i for i in range(toks.shape[0])]
+        eos = self.model.tokenizer.eos_token_id
+        finished = torch.zeros(toks.shape[0], dtype=torch.bool)
+        logits = []
+        decoder = decode_incrementally(self.model,toks,max_tokens_generated,*args,**kwargs)
+        next_tokens = None
         for i in range(max_tokens_generated):
-            logits = self.model(all_toks[generating, :-max_tokens_generated + i],*args,**kwargs)
-            next_tokens = logits[:,-1,:].argmax(dim=-1).to('cpu')
-            all_toks[generating,-max_tokens_generated+i] = next_tokens
+            # the tokens actually kept are fed back, so finished rows decode from EOS like `all_toks` says
+            step_logits,next_tokens = decoder.send(next_tokens)
+            logits.append(step_logits)
+            next_tokens = next_tokens.to('cpu')
+            # rows that already hit EOS keep emitting it
+            next_tokens[finished] = eos
+            all_toks[:,toks.shape[1]+i] = next_tokens.to(all_toks.device)
             if drop_refusals and any(negative_tok in next_tokens for negative_tok in self.negative_toks):
                 # refusals we handle differently: if it's misbehaving, we stop all batches and move on to the next one
                 break
             if stop_at_eos:
-                for batch_idx in generating:
-                    generating = [i for i in range(toks.shape[0]) if all_toks[i][-1] != self.model.tokenizer.eos_token_id]
-                if len(generating) == 0:
+                finished |= next_tokens == eos
+                if finished.all():
                     break
-        return logits, all_toks
+        return torch.cat(logits,dim=1), all_toks
+
+    def generate_continuously(
+        self,
+        instructions: List[str],
+        *model_args,
+        batch_size: int = 4,
+        max_tokens_generated: int = 64,
+        stop_at_eos: bool = True,
+        drop_refusals: bool = True,
+        **model_kwargs
+    ):
+        # like `generate`, but rows retire as soon as they finish and queued prompts take their slots;
+        # yields decoded prompt+completion as each finishes, with tokens/s in `self.throughput['test']`
+        ids = self.token_cache.ids(self.chat_template, instructions)
+        stop_tokens = ({self.model.tokenizer.eos_token_id} if stop_at_eos else set()) | (set(self.negative_toks) if drop_refusals else set())
+        batcher = ContinuousBatcher(self.model, batch_size, max_tokens_generated, stop_tokens, model_args, **model_kwargs)
+        for i,tokens in batcher.run(ids):
+            yield self.model.tokenizer.decode(ids[i].tolist()+tokens, skip_special_tokens=True)
+        self.throughput['test'] = batcher.tokens_per_second
 
     def generate(
         self,
@@ -440,13 +2020,32 @@ class ModelAbliterator:
         test_set: List[str] = None,
         N: int = 16,
         batch_size: int = 4,
+        memory_budget: int = None,
         **kwargs
     ):
+        # with `memory_budget` (bytes), batch sizes adapt to it and end up in `self.batch_sizes['test']`
         if test_set is None:
             test_set = self.harmful_inst_test
-        for prompts in batch(test_set[:min(len(test_set),N)], batch_size):
-            for i, res in enumerate(self.generate(prompts, *args, **kwargs)):
+        prompts = test_set[:min(len(test_set),N)]
+        self.batch_sizes.pop('test', None)
+        if memory_budget is None:
+            self.throughput.pop('test', None)
+            for res in self.generate_continuously(prompts, *args, batch_size=batch_size, **kwargs):
+                print(res)
+            return
+
+        max_tokens_generated = kwargs.get('max_tokens_generated', 64)
+        controller = BatchSizeController.for_model(self.model, memory_budget, batch_size, logits=True)
+        def generate_chunk(chunk):
+            for res in self.generate(chunk, *args, **kwargs):
                 print(res)
+        controller.run(
+            len(prompts),
+            lambda start,size: (prompts[start:start+size],),
+            generate_chunk,
+            lambda start,size: self.tokenize_instructions_fn(prompts[start:start+size]).shape[1] + max_tokens_generated
+        )
+        self.batch_sizes['test'] = controller.sizes
 
     def run_with_cache(
         self,
@@ -459,31 +2058,48 @@ class ModelAbliterator:
         clear_contexts: bool = False,
         fwd_hooks: List[str] = [],
         max_new_tokens: int = 1,
+        reduce_last: int = None,
         **model_kwargs
     ) -> Tuple[Float[Tensor, 'batch_size seq_len d_vocab'], Dict[str, Float[Tensor, 'batch_size seq_len d_model']]]:
+        # `reduce_last=k` caches only the mean of the last k positions per hook, i.e. [batch_size, d_model]
         if names_filter is None and self.activation_layers:
             def activation_layering(namefunc: str):
                 return any(s in namefunc for s in self.activation_layers)
             names_filter = activation_layering
 
-
-        cache_dict, fwd, bwd = self.model.get_caching_hooks(
-            names_filter,
-            incl_bwd,
-            device,
-            remove_batch_dim=remove_batch_dim,
-            pos_slice=utils.Slice(None)
-        )
+        if reduce_last:
+            if incl_bwd:
+                raise NotImplementedError("Backward caching is not supported with `reduce_last`")
+            cache_dict, fwd = get_reducing_hooks(self.model, names_filter, reduce_last)
+            bwd = []
+        elif not incl_bwd:
+            # generation runs one forward pass per new token, each appending its positions
+            cache_dict, fwd = get_appending_hooks(self.model, names_filter, device, remove_batch_dim)
+            bwd = []
+        elif not max_new_tokens:
+            raise ValueError("`incl_bwd` needs logits to backpropagate from; use `max_new_tokens=1`")
+        elif max_new_tokens > 1:
+            # gradients would have to flow through every decoding step, while the hooks only see the newest token
+            raise NotImplementedError("Backward caching is only supported for a single forward pass (`max_new_tokens` <= 1)")
+        else:
+            cache_dict, fwd, bwd = self.model.get_caching_hooks(
+                names_filter,
+                incl_bwd,
+                device,
+                remove_batch_dim=remove_batch_dim,
+                pos_slice=utils.Slice(None)
+            )
 
         fwd_hooks = fwd_hooks+fwd+self.fwd_hooks
 
-        if not max_new_tokens:
-            # must do at least 1 token
-            max_new_tokens = 1
-
         with self.model.hooks(fwd_hooks=fwd_hooks, bwd_hooks=bwd, reset_hooks_end=reset_hooks_end, clear_contexts=clear_contexts):
-            #model_out = self.model(*model_args,**model_kwargs)
-            model_out,toks = self.generate_logits(*model_args,max_tokens_generated=max_new_tokens, **model_kwargs)
+            if not max_new_tokens:
+                # activations only: one forward pass with no logits, stopping at `stop_at_layer` if given
+                model_kwargs.pop('drop_refusals', None)
+                model_kwargs.pop('stop_at_eos', None)
+                model_out = self.model(*model_args, return_type=None, **model_kwargs)
+            else:
+                model_out,toks = self.generate_logits(*model_args,max_tokens_generated=max_new_tokens, **model_kwargs)
             if incl_bwd:
                 model_out.backward()
 
@@ -494,19 +2110,25 @@ class ModelAbliterator:
         refusal_dirs: List[Float[Tensor, 'd_model']],
         W_O: bool = True,
         mlp: bool = True,
-        layers: List[str] = None
+        layers: List[str] = None,
+        subspace: bool = False,
+        batch_layers: bool = False
     ):
+        # `subspace=True` projects out the span of all the directions at once (W - (W Q) Q^T, Q an orthonormal basis of the
+        # span from an SVD that drops near-zero singular values, so duplicate or dependent directions don't add spurious
+        # axes), rewriting each matrix once instead of once per direction; it matches the sequential loop when the
+        # directions are orthogonal
         if layers == None:
             layers = list(l for l in range(1,self.model.cfg.n_layers))
+        if subspace:
+            apply_subspace_update(self,orthonormal_basis(list(refusal_dirs)),layers,W_O=W_O,mlp=mlp,batch_layers=batch_layers)
+            return
         for refusal_dir in refusal_dirs:
             for layer in layers:
                 for modifying in [(W_O,self.layer_attn),(mlp,self.layer_mlp)]:
                     if modifying[0]:
                         matrix = modifying[1](layer)
-                        if refusal_dir.device != matrix.device:
-                            refusal_dir = refusal_dir.to(matrix.device)
-                        proj = einops.einsum(matrix, refusal_dir.view(-1, 1), '... d_model, d_model single -> ... single') * refusal_dir
-                        modifying[1](layer,matrix - proj)
+                        modifying[1](layer,*WeightDelta.projection(matrix,refusal_dir))
 
     def induce_refusal_dir(
         self,
@@ -522,8 +2144,8 @@ class ModelAbliterator:
             for modifying in [(W_O,self.layer_attn),(mlp,self.layer_mlp)]:
                 if modifying[0]:
                     matrix = modifying[1](layer)
-                    if refusal_dir.device != matrix.device:
-                        refusal_dir = refusal_dir.to(matrix.device)
+                    if refusal_dir.device != matrix.device or refusal_dir.dtype != matrix.dtype:
+                        refusal_dir = refusal_dir.to(matrix.device, matrix.dtype)
                     proj = einops.einsum(matrix, refusal_dir.view(-1, 1), '... d_model, d_model single -> ... single') * refusal_dir
                     avg_proj = refusal_dir * self.get_avg_projections(utils.get_act_name(self.activation_layers[0], layer),refusal_dir)
                     modifying[1](layer,(matrix - proj) + avg_proj)
@@ -559,22 +2181,116 @@ class ModelAbliterator:
         finally:
             self.fwd_hooks = before_hooks
 
+    def test_dirs(
+        self,
+        refusal_dirs: Float[Tensor, 'n_dirs d_model']|List[Float[Tensor, 'd_model']],
+        N: int = 4,
+        sampled_token_ct: int = 8,
+        measure: str = 'max',
+        batch_measure: str = 'max',
+        batch_size: int = 64
+    ) -> List[Dict[str, Float[Tensor, 'd_model']]]:
+        # `test_dir(use_hooks=True)` for many directions at once: the test prompts are tokenized once and tiled per direction,
+        # each row's hooks ablate that row's direction, and `batch_size // N` directions share one generation
+        if not isinstance(refusal_dirs, Tensor):
+            refusal_dirs = torch.stack(list(refusal_dirs))
+
+        toks = self.tokenize_instructions_fn(instructions=self.harmful_inst_test[:N])
+        n = toks.shape[0]
+        per_batch = max(1, batch_size // n)
+        act_names = [act_name for ln,act_name in self.get_all_act_names()]
+
+        scores = []
+        for start in tqdm(range(0, len(refusal_dirs), per_batch)):
+            chunk = refusal_dirs[start:start+per_batch]
+            hook_fn = functools.partial(batched_directional_hook,directions=chunk.repeat_interleave(n,dim=0))
+            with self.model.hooks(fwd_hooks=self.fwd_hooks+[(act_name,hook_fn) for act_name in act_names]):
+                # rows never drop out, so every row keeps the direction it was tiled with
+                logits,_ = self.generate_logits(toks.repeat(len(chunk),1),max_tokens_generated=sampled_token_ct,drop_refusals=False,stop_at_eos=False)
+            for i in range(len(chunk)):
+                negative_score,positive_score = self.measure_scores_from_logits(logits[i*n:(i+1)*n],sampled_token_ct,measure=batch_measure)
+                scores.append({'negative':measure_fn(measure,negative_score).to('cpu'), 'positive':measure_fn(measure,positive_score).to('cpu')})
+            del logits
+        clear_mem()
+        return scores
+
     def find_best_refusal_dir(
         self,
         N: int = 4,
         positive: bool = False,
         use_hooks: bool = True,
-        invert: bool = False
+        invert: bool = False,
+        batch_size: int = 64,
+        top_k: int = None,
+        metric: str = 'cohens_d'
     ) -> List[Tuple[float,str]]:
+        # with hooks, all the candidates are scored by `test_dirs` in shared batches of up to `batch_size` rows
+        # `top_k` only generates for the best `top_k` directions by `separation_scores()[metric]`
         dirs = self.refusal_dirs(invert=invert)
         if self.modified:
             print("WARNING: Modified; will restore model to current modified state each run")
-        scores = []
-        for direction in tqdm(dirs.items()):
-            score = self.test_dir(direction[1],N=N,use_hooks=use_hooks)[int(positive)]
-            scores.append((score,direction))
+        candidates = list(dirs.items()) if top_k is None else dirs.topk(top_k,scores=self.separation_scores(invert=invert,refusal_dirs=dirs)[metric])
+        score_key = 'positive' if positive else 'negative'
+        if use_hooks:
+            results = self.test_dirs([direction for name,direction in candidates],N=N,batch_size=batch_size)
+        else:
+            results = [self.test_dir(direction,N=N,use_hooks=False) for name,direction in tqdm(candidates)]
+        scores = [(result[score_key],direction) for result,direction in zip(results,candidates)]
         return sorted(scores,key=lambda x:x[0])
 
+    def search_refusal_dir(
+        self,
+        token_budget: int = 20000,
+        keep: float = 0.5,
+        max_sampled_token_ct: int = 8,
+        positive: bool = False,
+        invert: bool = False,
+        batch_size: int = 64
+    ) -> Tuple[Tuple[float,Tuple[str,Float[Tensor, 'd_model']]], List[Dict]]:
+        # Successive halving over `refusal_dirs()`: every round scores the remaining candidates with `test_dirs` and keeps
+        # the best `keep` fraction, until one is left. What's left of `token_budget` (generated tokens) is split evenly over
+        # the remaining rounds, so survivors get more prompts and tokens each round. Ranked like `find_best_refusal_dir`.
+        # Returns the winner and the trail of every round's settings and scores.
+        if not 0 < keep < 1:
+            raise ValueError(f"keep must be between 0 and 1 (exclusive), got {keep}")
+        dirs = self.refusal_dirs(invert=invert)
+        if self.modified:
+            print("WARNING: Modified; will restore model to current modified state each run")
+        score_key = 'positive' if positive else 'negative'
+        candidates = list(dirs.keys())
+        if not candidates:
+            raise ValueError("No refusal directions to search; run cache_activations first")
+        trail = []
+        spent = 0
+        while True:
+            rounds_left = max(1, math.ceil(math.log(len(candidates)) / math.log(1/keep)))
+            per_candidate = max(token_budget - spent, 0) / (rounds_left * len(candidates))
+            sampled_token_ct = int(min(max_sampled_token_ct, max(1, math.sqrt(per_candidate))))
+            N = int(min(len(self.harmful_inst_test), max(1, per_candidate // sampled_token_ct)))
+
+            results = self.test_dirs(torch.stack([dirs[key] for key in candidates]),N=N,sampled_token_ct=sampled_token_ct,batch_size=batch_size)
+            ranked = sorted(zip([result[score_key] for result in results],candidates),key=lambda x:x[0])
+            tokens = len(candidates) * N * sampled_token_ct
+            spent += tokens
+            trail.append({
+                'candidates': len(candidates),
+                'N': N,
+                'sampled_token_ct': sampled_token_ct,
+                'tokens': tokens,
+                'scores': [(score.item(),key) for score,key in ranked]
+            })
+            if len(ranked) == 1:
+                break
+            # at least one candidate goes every round, so the search always ends
+            candidates = [key for score,key in ranked[:min(len(ranked) - 1, max(1, math.ceil(len(ranked) * keep)))]]
+            if len(candidates) == 1:
+                break
+
+        if spent > token_budget:
+            print(f"WARNING: token budget exceeded ({spent} > {token_budget}); even one prompt and token per candidate costs more")
+        score, key = ranked[0]
+        return (score,(key,dirs[key])), trail
+
     def measure_scores(
         self,
         N: int = 4,
@@ -598,7 +2314,7 @@ class ModelAbliterator:
         sequence: int,
         measure: str = 'max'
     ) -> Tuple[Float[Tensor, 'batch_size'], Float[Tensor, 'batch_size']]:
-        normalized_scores = torch.softmax(logits[:,-sequence:,:].to('cpu'),dim=-1)[:,:,list(self.positive_toks)+list(self.negative_toks)]
+        normalized_scores = token_probabilities(logits[:,-sequence:,:],list(self.positive_toks)+list(self.negative_toks)).to('cpu')
 
         normalized_positive,normalized_negative = torch.split(normalized_scores,[len(self.positive_toks), len(self.negative_toks)], dim=2)
 
@@ -657,11 +2373,14 @@ class ModelAbliterator:
         self,
         N: int = 128,
         batch_size: int = 8,
-        last_indices: int = 1
+        last_indices: int = 1,
+        memory_budget: int = None
     ) -> Dict[str, Float[Tensor, 'd_model']]:
         # Calculate mean squared error against currently loaded negative cached activation
         # Idea being to get a general sense of how the "normal" direction has been altered.
         # This is to compare ORIGINAL functionality to ABLATED functionality, not for ground truth.
+        if any(isinstance(v, RunningStats) for v in self.harmless.values()):
+            raise AssertionError("MSE needs per-prompt rows; run cache_activations with streaming=False")
 
         #load full training set to ensure alignment
         toks = self.tokenize_instructions_fn(instructions=self.harmful_inst_train[:N]+self.harmless_inst_train[:N])
@@ -672,11 +2391,11 @@ class ModelAbliterator:
         toks = toks[splitpos:]
         self.loss_harmless = {}
 
-        for i in tqdm(range(0,min(N,len(toks)),batch_size)):
-            logits,cache = self.run_with_cache(toks[i:min(i+batch_size,len(toks))])
+        def cache_batch(batch_toks):
+            logits,cache = self.run_with_cache(batch_toks,max_new_tokens=0,reduce_last=last_indices,stop_at_layer=self.get_cache_stop_layer())
             for key in cache:
                 if any(k in key for k in self.activation_layers):
-                    tensor = torch.mean(cache[key][:, -last_indices:, :],dim=1).to('cpu')
+                    tensor = cache[key].to('cpu')
                     if key not in self.loss_harmless:
                         self.loss_harmless[key] = tensor
                     else:
@@ -684,7 +2403,15 @@ class ModelAbliterator:
             del logits,cache
             clear_mem()
 
-        return {k:F.mse_loss(self.loss_harmless[k].float()[:N],self.harmless[k].float()[:N]) for k in self.loss_harmless}
+        if memory_budget is None:
+            for i in tqdm(range(0,min(N,len(toks)),batch_size)):
+                cache_batch(toks[i:min(i+batch_size,len(toks))])
+        else:
+            controller = BatchSizeController.for_model(self.model, memory_budget, batch_size)
+            controller.run(min(N,len(toks)), lambda start,size: (toks[start:start+size],), cache_batch, lambda start,size: toks.shape[1])
+            self.batch_sizes['mse_positive'] = controller.sizes
+
+        return {k:F.mse_loss(self.loss_harmless[k].float()[:N],activation_rows(self.harmless[k]).float()[:N]) for k in self.loss_harmless}
 
     def create_activation_cache(
         self,
@@ -693,27 +2420,65 @@ class ModelAbliterator:
         batch_size: int = 8,
         last_indices: int = 1,
         measure_refusal: int = 0,
-        stop_at_layer: int = None
-    ) -> Tuple[ActivationCache, List[str]]:
+        stop_at_layer: int = None,
+        streaming: bool = False,
+        covariance: bool = False,
+        batch_controller: BatchSizeController = None,
+        compact: str = None
+    ) -> Tuple[ActivationCache|Dict[str, RunningStats|CompactActivations], List[str]]:
         # Base functionality for creating an activation cache with a training set, prefer 'cache_activations' for regular usage
-
-        base = dict()
+        # `streaming=True` folds each batch into per-key RunningStats instead of keeping every prompt's row
+        # `compact='int8'|'fp16'` keeps every row, quantized per batch into CompactActivations
+
+        # `toks` may also be a BatchPlan, in which case per-prompt rows are put back in prompt order at the end
+        # Logits are only computed when scoring refusals (`measure_refusal > 1`); otherwise it's a single
+        # forward pass that skips the unembedding and stops at `stop_at_layer`
+        if measure_refusal > 1:
+            stop_at_layer = None
+
+        # The disk cache only ever holds unmodified, unhooked activations, so anything else bypasses it
+        use_disk_cache = (self.activation_disk_cache is not None and isinstance(toks, BatchPlan) and toks.prompts is not None
+                          and measure_refusal <= 1 and self.activation_layers is not None
+                          and not self.modified and not self.fwd_hooks)
+
+        # Transfers and host-side reduction run on a background thread; garbage collection happens once at the end
+        accumulator = ActivationAccumulator(streaming=streaming,covariance=covariance,compact=compact)
+        offloader = ActivationOffloader(accumulator)
         z_label = [] if measure_refusal > 1 else None
-        for i in tqdm(range(0,min(N,len(toks)),batch_size)):
-            logits,cache = self.run_with_cache(toks[i:min(i+batch_size,len(toks))],max_new_tokens=measure_refusal,stop_at_layer=stop_at_layer)
+        seen = []
+        total = toks.num_batches() if isinstance(toks, BatchPlan) else len(range(0,min(N,len(toks)),batch_size))
+        def cache_batch(indices, batch_toks):
+            # nothing is recorded until the forward succeeded, so an out-of-memory batch can be retried smaller
+            if use_disk_cache:
+                logits,cache = None,self.cached_activation_batch(toks,indices,last_indices=last_indices,stop_at_layer=stop_at_layer)
+            else:
+                logits,cache = self.run_with_cache(batch_toks,max_new_tokens=measure_refusal if measure_refusal > 1 else 0,reduce_last=last_indices,stop_at_layer=stop_at_layer)
             if measure_refusal > 1:
                 z_label.extend(self.measure_scores_from_logits(logits,measure_refusal)[0])
-            for key in cache:
-                if self.activation_layers is None or any(k in key for k in self.activation_layers):
-                    tensor = torch.mean(cache[key][:,-last_indices:,:].to('cpu'),dim=1)
-                    if key not in base:
-                        base[key] = tensor
-                    else:
-                        base[key] = torch.cat((base[key], tensor), dim=0)
+            offloader.submit({key:cache[key] for key in cache if self.activation_layers is None or any(k in key for k in self.activation_layers)})
+            seen.extend(indices)
 
-            del logits, cache
+        try:
+            if batch_controller is None:
+                for indices,batch_toks in tqdm(token_batches(toks,N,batch_size),total=total):
+                    cache_batch(indices,batch_toks)
+            elif isinstance(toks, BatchPlan):
+                batch_controller.run(len(toks), toks.take, cache_batch, toks.seq_len)
+            else:
+                batch_controller.run(min(N,len(toks)), lambda start,size: (list(range(start,start+size)),toks[start:start+size]), cache_batch, lambda start,size: toks.shape[1])
+        finally:
+            offloader.close()
             clear_mem()
 
+        if streaming:
+            return accumulator.result(), z_label
+
+        perm = restore_order(seen)
+        base = accumulator.result(perm)
+        if perm is not None and z_label is not None:
+            z_label = [z_label[i] for i in perm.tolist()]
+        if compact:
+            return base, z_label
         return ActivationCache(base,self.model), z_label
 
     def cache_activations(
@@ -725,9 +2490,17 @@ class ModelAbliterator:
         reset: bool = True,
         activation_layers: int = -1,
         preserve_harmless: bool = True,
-        stop_at_layer: int = None
+        stop_at_layer: int = None,
+        streaming: bool = False,
+        covariance: bool = False,
+        bucket_by_length: bool = True,
+        append: bool = False,
+        memory_budget: int = None,
+        compact: str = None
     ):
-        if hasattr(self,"current_state"):
+        # `append=True` only runs prompts that aren't cached yet and merges them into the current cache
+        # `compact='int8'|'fp16'` stores rows compactly; see `refusal_dir_error_bounds()` for what that costs
+        if self._snapshots:
             print("WARNING: Caching activations using a context")
         if self.modified:
             print("WARNING: Running modified model")
@@ -735,10 +2508,15 @@ class ModelAbliterator:
         if activation_layers == -1:
             activation_layers = self.activation_layers
 
+        if append and (self.cached_prompts is None or None in self.cached_prompts.values()):
+            print("WARNING: No record of which prompts are cached; recaching everything")
+            append = False
+
         harmless_is_set = len(getattr(self,"harmless",{})) > 0
-        preserve_harmless = harmless_is_set and preserve_harmless
+        # in append mode nothing gets thrown away, so harmless always gets its new prompts added
+        preserve_harmless = harmless_is_set and preserve_harmless and not append
 
-        if reset == True or getattr(self,"harmless",None) is None:
+        if not append and (reset == True or getattr(self,"harmless",None) is None):
             self.harmful = {}
             if not preserve_harmless:
                 self.harmless = {}
@@ -746,18 +2524,67 @@ class ModelAbliterator:
             self.harmful_z_label = []
             self.harmless_z_label = []
 
-        # load the full training set here to align all the dimensions (even if we're not going to run harmless)
-        toks = self.tokenize_instructions_fn(instructions=self.harmful_inst_train[:N]+self.harmless_inst_train[:N])
+        harmful_insts = self.harmful_inst_train[:N]
+        harmless_insts = self.harmless_inst_train[:N]
+        if append:
+            # only prompts that aren't part of the current statistics get a forward pass
+            cached_harmful,cached_harmless = set(self.cached_prompts['harmful']),set(self.cached_prompts['harmless'])
+            harmful_insts = [p for p in harmful_insts if p not in cached_harmful]
+            harmless_insts = [p for p in harmless_insts if p not in cached_harmless]
+
+        self.cache_stats = {}
+        if bucket_by_length:
+            # each set is batched by token length, so batches only pad to their own longest prompt
+            harmful_toks = self.plan_batches(harmful_insts,batch_size,None if append else self.pretokenized_rows('harmful',N))
+            harmless_toks = None if preserve_harmless else self.plan_batches(harmless_insts,batch_size,None if append else self.pretokenized_rows('harmless',N))
+            self.cache_stats['harmful'] = harmful_toks.stats()
+            if harmless_toks is not None:
+                self.cache_stats['harmless'] = harmless_toks.stats()
+        else:
+            # load the full training set here to align all the dimensions (even if we're not going to run harmless)
+            toks = self.tokenize_instructions_fn(instructions=harmful_insts+harmless_insts)
 
-        splitpos = min(N,len(self.harmful_inst_train))
-        harmful_toks = toks[:splitpos]
-        harmless_toks = toks[splitpos:]
+            splitpos = len(harmful_insts)
+            harmful_toks = toks[:splitpos]
+            harmless_toks = toks[splitpos:]
 
         last_indices = last_indices or 1
 
-        self.harmful,self.harmful_z_label = self.create_activation_cache(harmful_toks,N=N,batch_size=batch_size,last_indices=last_indices,measure_refusal=measure_refusal,stop_at_layer=None)
+        if stop_at_layer is None and measure_refusal <= 1:
+            stop_at_layer = self.get_cache_stop_layer()
+
+        # with `memory_budget` (bytes) batch sizes adapt to it; the sizes used go to `self.batch_sizes`
+        controller = BatchSizeController.for_model(self.model,memory_budget,batch_size,logits=measure_refusal > 1) if memory_budget is not None else None
+
+        harmful,harmful_z_label = self.create_activation_cache(harmful_toks,N=N,batch_size=batch_size,last_indices=last_indices,measure_refusal=measure_refusal,stop_at_layer=stop_at_layer,streaming=streaming,covariance=covariance,batch_controller=controller,compact=compact)
+        if controller is not None:
+            self.batch_sizes['harmful'] = list(controller.sizes)
+        if append:
+            self.harmful = merge_activations(self.harmful,harmful,self.model)
+            if harmful_z_label is not None:
+                self.harmful_z_label = (getattr(self,'harmful_z_label',None) or []) + harmful_z_label
+            self.cached_prompts['harmful'] = self.cached_prompts['harmful'] + harmful_insts
+        else:
+            self.harmful,self.harmful_z_label = harmful,harmful_z_label
+            self.cached_prompts = {'harmful':list(harmful_insts), 'harmless':self.cached_prompts['harmless'] if self.cached_prompts else None}
+
         if not preserve_harmless:
-            self.harmless, self.harmless_z_label = self.create_activation_cache(harmless_toks,N=N,batch_size=batch_size,last_indices=last_indices,measure_refusal=measure_refusal,stop_at_layer=None)
+            ran = len(controller.sizes) if controller is not None else 0
+            harmless,harmless_z_label = self.create_activation_cache(harmless_toks,N=N,batch_size=batch_size,last_indices=last_indices,measure_refusal=measure_refusal,stop_at_layer=stop_at_layer,streaming=streaming,covariance=covariance,batch_controller=controller,compact=compact)
+            if controller is not None:
+                self.batch_sizes['harmless'] = controller.sizes[ran:]
+            if append:
+                self.harmless = merge_activations(self.harmless,harmless,self.model)
+                if harmless_z_label is not None:
+                    self.harmless_z_label = (getattr(self,'harmless_z_label',None) or []) + harmless_z_label
+                self.cached_prompts['harmless'] = self.cached_prompts['harmless'] + harmless_insts
+            else:
+                self.harmless,self.harmless_z_label = harmless,harmless_z_label
+                self.cached_prompts['harmless'] = list(harmless_insts)
+
+        if self.activation_disk_cache is not None:
+            disk = self.activation_disk_cache
+            self.cache_stats['disk_cache'] = {'hits':disk.hits, 'misses':disk.misses, 'bytes':disk.size}
 
     def save_abliterated_model(self, save_name: Optional[str] = None) -> str:
         """Save the abliterated model state"""
@@ -776,14 +2603,22 @@ class ModelAbliterator:
         
         # Split state dict into chunks similar to original files if possible
         if self.model_files:
-            # Try to maintain original file structure
-            original_chunks = {f.stem: load_file(f) for f in self.model_files}
-            for file_stem, original_chunk in original_chunks.items():
+            # Try to maintain original file structure; only the key lists are read, not the tensors
+            for file in self.model_files:
+                with safe_open(file, framework='pt') as f:
+                    keys = list(f.keys())
                 # Create new chunk with modified weights
-                new_chunk = {k: state_dict[k] for k in original_chunk.keys() if k in state_dict}
-                save_file(new_chunk, save_dir / f"{file_stem}.safetensors")
+                new_chunk = {k: state_dict[k].contiguous() for k in keys if k in state_dict}
+                # the target may be a link to the source model; unlink so writing doesn't clobber it
+                target = save_dir / f"{file.stem}.safetensors"
+                if target.exists() or target.is_symlink():
+                    target.unlink()
+                save_file(new_chunk, target)
         else:
             # Save as single file if no original structure to follow
-            save_file(state_dict, save_dir / "model.safetensors")
+            target = save_dir / "model.safetensors"
+            if target.exists() or target.is_symlink():
+                target.unlink()
+            save_file(state_dict, target)
         
         return str(save_dir)
\ No newline at end of file
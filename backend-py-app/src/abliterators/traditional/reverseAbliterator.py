@@ -10,6 +10,13 @@ from typing import Callable, Dict, List, Set, Tuple
 from transformer_lens import HookedTransformer, utils, ActivationCache
 from transformer_lens.hook_points import HookPoint
 from jaxtyping import Float, Int
+import os
+import shutil
+import tempfile
+import weakref
+from pathlib import Path
+
+from abliterator import ACTIVATION_STORE_CHECKPOINTS, ActivationAccumulator, ActivationOffloader, BatchPlan, BatchSizeController, ChatTemplate, CheckpointStore, CompactActivations, ContinuousBatcher, DirectionBank, LLAMA3_CHAT_TEMPLATE, MODIFIABLE_WEIGHTS, ModelPathManager, OriginalWeights, RunningStats, TokenizationCache, TokenizedDataset, WeightDelta, activation_mean, apply_subspace_update, batch, decode_incrementally, direction_error_bound, direction_keys, get_appending_hooks, get_reducing_hooks, load_activation_store, merge_activations, orthonormal_basis, pack_modified_layers, prepare_dataset, restore_checkpoint, restore_order, save_activation_store, token_batches, token_probabilities, unpack_modified_layers
 
 class ReverseAbliterator:
     def __init__(
@@ -22,8 +29,12 @@ class ReverseAbliterator:
         activation_layers: List[str] = ['resid_pre', 'resid_post', 'mlp_out', 'attn_out'],
         chat_template: str = None,
         target_toks: List[int]|Tuple[int]|Set[int]|Int[Tensor, '...'] = None,
+        checkpoint_dir: str = None,
+        original_state_dir: str = None,
+        model_dir: str = "models",
     ):
         self.MODEL_PATH = model
+        self.path_manager = ModelPathManager(model_dir)
         if n_devices is None and torch.cuda.is_available():
             n_devices = torch.cuda.device_count()
         elif n_devices is None:
@@ -44,19 +55,34 @@ class ReverseAbliterator:
         self.model.tokenizer.padding_side = 'left'
         self.model.tokenizer.pad_token = self.model.tokenizer.eos_token
         self.chat_template = chat_template or ChatTemplate(self, LLAMA3_CHAT_TEMPLATE)
+        self.token_cache = TokenizationCache(self.model.tokenizer)
 
         self.hidden_size = self.model.cfg.d_model
-        self.original_state = {k:v.to('cpu') for k,v in self.model.state_dict().items()}
+        # the unmodified weights, spilled next to the models directory as they're first edited or loaded over
+        self.original_state = OriginalWeights(self.model, original_state_dir, self.path_manager.base_dir)
+        # entries `load_modified_model` overwrote, restored by `reset_state` along with `modified_layers`
+        self.loaded_keys = set()
         self.target = {}
         self.baseline = {}
         self.modified_layers = {'mlp':{}, 'W_O':{}}
-        self.checkpoints = []
+        self.checkpoints = CheckpointStore(checkpoint_dir)
+        self.cached_prompts = None
+        self.pretokenized = None
 
         if cache_fname is not None:
-            outs = torch.load(cache_fname, map_location='cpu')
-            self.target, self.baseline, modified_layers, checkpoints = outs[:4]
-            self.checkpoints = checkpoints or []
-            self.modified_layers = modified_layers
+            if os.path.isdir(cache_fname):
+                groups, state = load_activation_store(cache_fname)
+                self.target, self.baseline = groups['target'], groups['baseline']
+                modified_layers, checkpoints = state.get('modified_layers'), state.get('checkpoints')
+                self.cached_prompts = state.get('cached_prompts')
+                if state.get('checkpoint_store'):
+                    self.checkpoints.extend(CheckpointStore(os.path.join(cache_fname, state['checkpoint_store'])))
+            else:
+                outs = torch.load(cache_fname, map_location='cpu')
+                self.target, self.baseline, modified_layers, checkpoints = outs[:4]
+            for c in checkpoints or []:
+                self.checkpoints.save(unpack_modified_layers(c))
+            self.modified_layers = unpack_modified_layers(modified_layers)
 
         self.target_inst_train, self.target_inst_test = prepare_dataset(dataset[0])
         self.baseline_inst_train, self.baseline_inst_test = prepare_dataset(dataset[1])
@@ -66,32 +92,67 @@ class ReverseAbliterator:
         self.activation_layers = [activation_layers] if isinstance(activation_layers, str) else activation_layers
         self.target_toks = target_toks or {32, 1271, 8586, 96556, 78145}  # Default to some positive tokens
         self._blacklisted = set()
+        self.batch_sizes = {}
+        self.throughput = {}
 
     def reset_state(self):
+        for kind, layers in self.modified_layers.items():
+            for layer in layers:
+                param = self.model.get_parameter(MODIFIABLE_WEIGHTS[kind].format(layer))
+                param.data = self.original_state[MODIFIABLE_WEIGHTS[kind].format(layer)].to(param.device, param.dtype)
+        if self.loaded_keys:
+            self.model.load_state_dict({name: self.original_state[name] for name in self.loaded_keys}, strict=False)
         self.modified = False
         self.modified_layers = {'mlp':{}, 'W_O':{}}
-        self.model.load_state_dict(self.original_state)
+        self.loaded_keys = set()
+
+    def checkpoint(self, label: str = None) -> int:
+        return self.checkpoints.save(self.modified_layers, label)
+
+    def list_checkpoints(self) -> List[Dict]:
+        return self.checkpoints.list()
+
+    def restore(self, checkpoint_id: int) -> Dict[str, List[int]]:
+        return restore_checkpoint(self, self.checkpoints, checkpoint_id)
 
-    def checkpoint(self):
-        self.checkpoints.append(self.modified_layers.copy())
+    def diff(self, a: int, b: int = None) -> Dict[str, List[int]]:
+        store = self.checkpoints
+        return store.diff_versions(store.manifest(a)['layers'], store.versions(self.modified_layers) if b is None else store.manifest(b)['layers'])
 
     def save_activations(self, fname: str):
-        torch.save([self.target, self.baseline, self.modified_layers if self.modified_layers['mlp'] or self.modified_layers['W_O'] else None, self.checkpoints if len(self.checkpoints) > 0 else None], fname)
+        if len(self.checkpoints) > 0:
+            self.checkpoints.export(os.path.join(fname, ACTIVATION_STORE_CHECKPOINTS))
+        save_activation_store(fname, {'target': self.target, 'baseline': self.baseline}, {
+            'modified_layers': pack_modified_layers(self.modified_layers) if self.modified_layers['mlp'] or self.modified_layers['W_O'] else None,
+            'checkpoint_store': ACTIVATION_STORE_CHECKPOINTS if len(self.checkpoints) > 0 else None,
+            'cached_prompts': self.cached_prompts
+        })
 
     def calculate_enhancement_dirs(self, key: str) -> Dict[str, Float[Tensor, 'd_model']]:
         dirs = {
-            'target_mean': torch.mean(self.target[key], dim=0),
-            'baseline_mean': torch.mean(self.baseline[key], dim=0)
+            'target_mean': activation_mean(self.target[key]),
+            'baseline_mean': activation_mean(self.baseline[key])
         }
         dirs['enhancement_dir'] = dirs['target_mean'] - dirs['baseline_mean']
         return dirs
 
-    def enhancement_dirs(self) -> Dict[str, Float[Tensor, 'd_model']]:
+    def enhancement_dir_error_bounds(self) -> Dict[str, float]:
+        # how far each of `enhancement_dirs()` can be from the full-precision one (0 unless compact)
+        bounds = {}
+        for key in direction_keys(self.target.keys()):
+            target_acts, baseline_acts = self.target[key], self.baseline[key]
+            direction = activation_mean(target_acts) - activation_mean(baseline_acts)
+            bounds[key] = direction_error_bound(target_acts, baseline_acts, direction)
+        return bounds
+
+    def enhancement_dirs(self) -> DirectionBank:
         if not self.target:
             raise IndexError("No cache")
 
-        enhancement_dirs = {key: self.calculate_enhancement_dirs(key) for key in self.target if '.0.' not in key}
-        return {key: (v['enhancement_dir'] / v['enhancement_dir'].norm()).to('cpu') for key, v in enhancement_dirs.items()}
+        keys = direction_keys(self.target.keys())
+        target_means = torch.stack([activation_mean(self.target[key]).to('cpu', torch.float32) for key in keys])
+        baseline_means = torch.stack([activation_mean(self.baseline[key]).to('cpu', torch.float32) for key in keys])
+        return DirectionBank.from_means(keys, target_means, baseline_means)
 
     def apply_enhancement_dirs(
         self,
@@ -99,34 +160,54 @@ class ReverseAbliterator:
         W_O: bool = True,
         mlp: bool = True,
         layers: List[int] = None,
-        strength: float = 1.0
+        strength: float = 1.0,
+        subspace: bool = False,
+        batch_layers: bool = False
     ):
+        # `subspace=True` amplifies the span of all the directions in one pass per matrix (W + strength * (W Q) Q^T)
         if layers is None:
             layers = list(range(1, self.model.cfg.n_layers))
+        if subspace:
+            apply_subspace_update(self, orthonormal_basis(list(enhancement_dirs)), layers, W_O=W_O, mlp=mlp, scale=strength, batch_layers=batch_layers)
+            return
         for enhancement_dir in enhancement_dirs:
             for layer in layers:
                 for modifying in [(W_O, self.layer_attn), (mlp, self.layer_mlp)]:
                     if modifying[0]:
                         matrix = modifying[1](layer)
-                        if enhancement_dir.device != matrix.device:
-                            enhancement_dir = enhancement_dir.to(matrix.device)
-                        proj = einops.einsum(matrix, enhancement_dir.view(-1, 1), '... d_model, d_model single -> ... single') * enhancement_dir
-                        modifying[1](layer, matrix + strength * proj)
+                        modifying[1](layer, *WeightDelta.projection(matrix, enhancement_dir, scale=strength))
 
-    def layer_attn(self, layer: int, replacement: Float[Tensor, "d_model"] = None) -> Float[Tensor, "d_model"]:
+    def layer_attn(self, layer: int, replacement: Float[Tensor, "d_model"] = None, delta: WeightDelta = None) -> Float[Tensor, "d_model"]:
         if replacement is not None and layer not in self._blacklisted:
             self.modified = True
+            self.original_state.keep(MODIFIABLE_WEIGHTS['W_O'].format(layer))
             self.model.blocks[layer].attn.W_O.data = replacement.to(self.model.blocks[layer].attn.W_O.device)
-            self.modified_layers['W_O'][layer] = self.modified_layers.get(layer, []) + [(self.model.blocks[layer].attn.W_O.data.to('cpu'), replacement.to('cpu'))]
+            self.modified_layers['W_O'].setdefault(layer, []).append(delta or WeightDelta(dense=replacement.to('cpu')))
         return self.model.blocks[layer].attn.W_O.data
 
-    def layer_mlp(self, layer: int, replacement: Float[Tensor, "d_model"] = None) -> Float[Tensor, "d_model"]:
+    def layer_mlp(self, layer: int, replacement: Float[Tensor, "d_model"] = None, delta: WeightDelta = None) -> Float[Tensor, "d_model"]:
         if replacement is not None and layer not in self._blacklisted:
             self.modified = True
+            self.original_state.keep(MODIFIABLE_WEIGHTS['mlp'].format(layer))
             self.model.blocks[layer].mlp.W_out.data = replacement.to(self.model.blocks[layer].mlp.W_out.device)
-            self.modified_layers['mlp'][layer] = self.modified_layers.get(layer, []) + [(self.model.blocks[layer].mlp.W_out.data.to('cpu'), replacement.to('cpu'))]
+            self.modified_layers['mlp'].setdefault(layer, []).append(delta or WeightDelta(dense=replacement.to('cpu')))
         return self.model.blocks[layer].mlp.W_out.data
 
+    def replay_modifications(self, kind: str, layer: int) -> Float[Tensor, "d_model"]:
+        param = self.model.get_parameter(MODIFIABLE_WEIGHTS[kind].format(layer))
+        matrix = self.original_state[MODIFIABLE_WEIGHTS[kind].format(layer)].to(param.device, param.dtype)
+        for delta in self.modified_layers[kind].get(layer, []):
+            matrix = delta.apply(matrix)
+        return matrix
+
+    def undo_modification(self, kind: str, layer: int) -> WeightDelta:
+        delta = self.modified_layers[kind][layer].pop()
+        if not self.modified_layers[kind][layer]:
+            del self.modified_layers[kind][layer]
+        self.model.get_parameter(MODIFIABLE_WEIGHTS[kind].format(layer)).data = self.replay_modifications(kind, layer)
+        self.modified = any(self.modified_layers[k] for k in self.modified_layers)
+        return delta
+
     def cache_activations(
         self,
         N: int = 128,
@@ -135,6 +216,12 @@ class ReverseAbliterator:
         reset: bool = True,
         activation_layers: int = -1,
         preserve_baseline: bool = True,
+        streaming: bool = False,
+        covariance: bool = False,
+        bucket_by_length: bool = True,
+        append: bool = False,
+        memory_budget: int = None,
+        compact: str = None,
     ):
         if hasattr(self, "current_state"):
             print("WARNING: Caching activations using a context")
@@ -144,25 +231,62 @@ class ReverseAbliterator:
         if activation_layers == -1:
             activation_layers = self.activation_layers
 
+        if append and (self.cached_prompts is None or None in self.cached_prompts.values()):
+            print("WARNING: No record of which prompts are cached; recaching everything")
+            append = False
+
         baseline_is_set = len(getattr(self, "baseline", {})) > 0
-        preserve_baseline = baseline_is_set and preserve_baseline
+        preserve_baseline = baseline_is_set and preserve_baseline and not append
 
-        if reset or getattr(self, "baseline", None) is None:
+        if not append and (reset or getattr(self, "baseline", None) is None):
             self.target = {}
             if not preserve_baseline:
                 self.baseline = {}
 
-        toks = self.tokenize_instructions_fn(instructions=self.target_inst_train[:N] + self.baseline_inst_train[:N])
+        target_insts = self.target_inst_train[:N]
+        baseline_insts = self.baseline_inst_train[:N]
+        if append:
+            cached_target, cached_baseline = set(self.cached_prompts['target']), set(self.cached_prompts['baseline'])
+            target_insts = [p for p in target_insts if p not in cached_target]
+            baseline_insts = [p for p in baseline_insts if p not in cached_baseline]
+
+        if bucket_by_length:
+            target_toks = self.plan_batches(target_insts, batch_size, None if append else self.pretokenized_rows('target', N))
+            baseline_toks = None if preserve_baseline else self.plan_batches(baseline_insts, batch_size, None if append else self.pretokenized_rows('baseline', N))
+            self.cache_stats = {'target': target_toks.stats()}
+            if baseline_toks is not None:
+                self.cache_stats['baseline'] = baseline_toks.stats()
+        else:
+            toks = self.tokenize_instructions_fn(instructions=target_insts + baseline_insts)
 
-        splitpos = min(N, len(self.target_inst_train))
-        target_toks = toks[:splitpos]
-        baseline_toks = toks[splitpos:]
+            splitpos = len(target_insts)
+            target_toks = toks[:splitpos]
+            baseline_toks = toks[splitpos:]
 
         last_indices = last_indices or 1
+        controller = BatchSizeController.for_model(self.model, memory_budget, batch_size) if memory_budget is not None else None
+
+        target = self.create_activation_cache(target_toks, N=N, batch_size=batch_size, last_indices=last_indices, streaming=streaming, covariance=covariance, batch_controller=controller, compact=compact)
+        if controller is not None:
+            self.batch_sizes['target'] = list(controller.sizes)
+        if append:
+            self.target = merge_activations(self.target, target)
+            self.cached_prompts['target'] = self.cached_prompts['target'] + target_insts
+        else:
+            self.target = target
+            self.cached_prompts = {'target': list(target_insts), 'baseline': self.cached_prompts['baseline'] if self.cached_prompts else None}
 
-        self.target = self.create_activation_cache(target_toks, N=N, batch_size=batch_size, last_indices=last_indices)
         if not preserve_baseline:
-            self.baseline = self.create_activation_cache(baseline_toks, N=N, batch_size=batch_size, last_indices=last_indices)
+            ran = len(controller.sizes) if controller is not None else 0
+            baseline = self.create_activation_cache(baseline_toks, N=N, batch_size=batch_size, last_indices=last_indices, streaming=streaming, covariance=covariance, batch_controller=controller, compact=compact)
+            if controller is not None:
+                self.batch_sizes['baseline'] = controller.sizes[ran:]
+            if append:
+                self.baseline = merge_activations(self.baseline, baseline)
+                self.cached_prompts['baseline'] = self.cached_prompts['baseline'] + baseline_insts
+            else:
+                self.baseline = baseline
+                self.cached_prompts['baseline'] = list(baseline_insts)
 
     def create_activation_cache(
         self,
@@ -170,22 +294,36 @@ class ReverseAbliterator:
         N: int = 128,
         batch_size: int = 8,
         last_indices: int = 1,
-    ) -> Dict[str, Float[Tensor, 'batch d_model']]:
-        base = {}
-        for i in tqdm(range(0, min(N, len(toks)), batch_size)):
-            logits, cache = self.run_with_cache(toks[i:min(i+batch_size, len(toks))])
-            for key in cache:
-                if self.activation_layers is None or any(k in key for k in self.activation_layers):
-                    tensor = torch.mean(cache[key][:, -last_indices:, :].to('cpu'), dim=1)
-                    if key not in base:
-                        base[key] = tensor
-                    else:
-                        base[key] = torch.cat((base[key], tensor), dim=0)
-            del logits, cache
+        streaming: bool = False,
+        covariance: bool = False,
+        batch_controller: BatchSizeController = None,
+        compact: str = None,
+    ) -> Dict[str, Float[Tensor, 'batch d_model']|RunningStats|CompactActivations]:
+        accumulator = ActivationAccumulator(streaming=streaming, covariance=covariance, compact=compact)
+        offloader = ActivationOffloader(accumulator)
+        seen = []
+        total = toks.num_batches() if isinstance(toks, BatchPlan) else len(range(0, min(N, len(toks)), batch_size))
+        def cache_batch(indices, batch_toks):
+            logits, cache = self.run_with_cache(batch_toks, max_new_tokens=0, reduce_last=last_indices)
+            offloader.submit({key: cache[key] for key in cache if self.activation_layers is None or any(k in key for k in self.activation_layers)})
+            seen.extend(indices)
+
+        try:
+            if batch_controller is None:
+                for indices, batch_toks in tqdm(token_batches(toks, N, batch_size), total=total):
+                    cache_batch(indices, batch_toks)
+            elif isinstance(toks, BatchPlan):
+                batch_controller.run(len(toks), toks.take, cache_batch, toks.seq_len)
+            else:
+                batch_controller.run(min(N, len(toks)), lambda start, size: (list(range(start, start + size)), toks[start:start + size]), cache_batch, lambda start, size: toks.shape[1])
+        finally:
+            offloader.close()
             gc.collect()
             torch.cuda.empty_cache()
 
-        return base
+        if streaming:
+            return accumulator.result()
+        return accumulator.result(restore_order(seen))
 
     def measure_enhancement(
         self,
@@ -205,7 +343,7 @@ class ReverseAbliterator:
         sequence: int,
         measure: str = 'max'
     ) -> Float[Tensor, 'batch_size']:
-        normalized_scores = torch.softmax(logits[:, -sequence:, :].to('cpu'), dim=-1)[:, :, list(self.target_toks)]
+        normalized_scores = token_probabilities(logits[:, -sequence:, :], self.target_toks).to('cpu')
         max_score_per_sequence = torch.max(normalized_scores, dim=-1)[0]
         score_per_batch = getattr(torch, measure)(max_score_per_sequence, dim=-1)[0]
         return score_per_batch
@@ -215,21 +353,26 @@ class ReverseAbliterator:
         *model_args,
         names_filter: Callable[[str], bool] = None,
         max_new_tokens: int = 1,
+        reduce_last: int = None,
         **model_kwargs
     ) -> Tuple[Float[Tensor, 'batch_size seq_len d_vocab'], Dict[str, Float[Tensor, 'batch_size seq_len d_model']]]:
         if names_filter is None and self.activation_layers:
             names_filter = lambda namefunc: any(s in namefunc for s in self.activation_layers)
 
-        cache_dict, fwd, _ = self.model.get_caching_hooks(
-            names_filter,
-            remove_batch_dim=False,
-            pos_slice=utils.Slice(None)
-        )
+        if reduce_last:
+            cache_dict, fwd = get_reducing_hooks(self.model, names_filter, reduce_last)
+        else:
+            # generation runs one forward pass per new token, each appending its positions
+            cache_dict, fwd = get_appending_hooks(self.model, names_filter)
 
         fwd_hooks = fwd + self.fwd_hooks
 
         with self.model.hooks(fwd_hooks=fwd_hooks):
-            model_out, _ = self.generate_logits(*model_args, max_tokens_generated=max_new_tokens, **model_kwargs)
+            if not max_new_tokens:
+                # activations only, skip the unembedding
+                model_out = self.model(*model_args, return_type=None, **model_kwargs)
+            else:
+                model_out, _ = self.generate_logits(*model_args, max_tokens_generated=max_new_tokens, **model_kwargs)
 
         return model_out, cache_dict
 
@@ -238,22 +381,58 @@ class ReverseAbliterator:
         toks: Int[Tensor, 'batch_size seq_len'],
         *args,
         max_tokens_generated: int = 1,
+        stop_at_eos: bool = False,
         **kwargs
     ) -> Tuple[Float[Tensor, 'batch_size seq_len d_vocab'], Int[Tensor, 'batch_size seq_len']]:
         all_toks = torch.zeros((toks.shape[0], toks.shape[1] + max_tokens_generated), dtype=torch.long, device=toks.device)
         all_toks[:, :toks.shape[1]] = toks
+        eos = self.model.tokenizer.eos_token_id
+        finished = torch.zeros(toks.shape[0], dtype=torch.bool)
+        logits = []
+        decoder = decode_incrementally(self.model, toks, max_tokens_generated, *args, **kwargs)
+        next_tokens = None
         for i in range(max_tokens_generated):
-            logits = self.model(all_toks[:, :-max_tokens_generated + i], *args, **kwargs)
-            next_tokens = logits[:, -1, :].argmax(dim=-1)
-            all_toks[:, -max_tokens_generated + i] = next_tokens
-        return logits, all_toks
+            step_logits, next_tokens = decoder.send(next_tokens)
+            logits.append(step_logits)
+            next_tokens = next_tokens.to('cpu')
+            next_tokens[finished] = eos
+            all_toks[:, toks.shape[1] + i] = next_tokens.to(all_toks.device)
+            if stop_at_eos:
+                finished |= next_tokens == eos
+                if finished.all():
+                    break
+        return torch.cat(logits, dim=1), all_toks
 
     def tokenize_instructions_fn(
         self,
         instructions: List[str]
     ) -> Int[Tensor, 'batch_size seq_len']:
-        prompts = [self.chat_template.format(instruction=instruction) for instruction in instructions]
-        return self.model.tokenizer(prompts, padding=True, truncation=False, return_tensors="pt").input_ids
+        return self.token_cache.batch(self.chat_template, instructions)
+
+    def plan_batches(
+        self,
+        instructions: List[str],
+        batch_size: int,
+        pretokenized: TokenizedDataset = None
+    ) -> BatchPlan:
+        ids = pretokenized if pretokenized is not None else self.token_cache.ids(self.chat_template, instructions)
+        return BatchPlan(ids, self.model.tokenizer.pad_token_id, batch_size)
+
+    def pretokenize(self, path: str = None) -> str:
+        root = Path(path) if path else Path(tempfile.mkdtemp(prefix='abliterator-tokens-'))
+        if path is None:
+            weakref.finalize(self, shutil.rmtree, root, True)
+        self.pretokenized = {
+            name: TokenizedDataset.build(self.model.tokenizer, self.chat_template, instructions, root / name)
+            for name, instructions in (('target', self.target_inst_train), ('baseline', self.baseline_inst_train))
+        }
+        return str(root)
+
+    def pretokenized_rows(self, name: str, N: int) -> TokenizedDataset:
+        dataset = (self.pretokenized or {}).get(name)
+        if dataset is None or not dataset.matches(self.chat_template, getattr(self, f"{name}_inst_train")):
+            return None
+        return dataset[:N]
 
     def enhance_model(
         self,
@@ -261,6 +440,7 @@ class ReverseAbliterator:
         W_O: bool = True,
         mlp: bool = True,
         strength: float = 1.0,
+        subspace: bool = False,
     ):
         enhancement_directions = self.enhancement_dirs()
         self.apply_enhancement_dirs(
@@ -268,7 +448,8 @@ class ReverseAbliterator:
             W_O=W_O,
             mlp=mlp,
             layers=layers,
-            strength=strength
+            strength=strength,
+            subspace=subspace
         )
 
     def test_enhancement(
@@ -276,16 +457,40 @@ class ReverseAbliterator:
         N: int = 16,
         batch_size: int = 4,
         max_tokens_generated: int = 64,
+        memory_budget: int = None,
     ):
-        for prompts in batch(self.target_inst_test[:min(len(self.target_inst_test), N)], batch_size):
+        def generate_batch(prompts):
             toks = self.tokenize_instructions_fn(prompts)
-            _, all_toks = self.generate_logits(toks, max_tokens_generated=max_tokens_generated)
+            _, all_toks = self.generate_logits(toks, max_tokens_generated=max_tokens_generated, stop_at_eos=True)
             responses = self.model.tokenizer.batch_decode(all_toks, skip_special_tokens=True)
             for prompt, response in zip(prompts, responses):
                 print(f"Prompt: {prompt}\nResponse: {response}\n")
 
+        test_set = self.target_inst_test[:min(len(self.target_inst_test), N)]
+        self.batch_sizes.pop('test', None)
+        if memory_budget is None:
+            # continuous batching: a finished row frees its slot for the next queued prompt right away
+            self.throughput.pop('test', None)
+            ids = self.token_cache.ids(self.chat_template, test_set)
+            batcher = ContinuousBatcher(self.model, batch_size, max_tokens_generated, {self.model.tokenizer.eos_token_id})
+            for i, tokens in batcher.run(ids):
+                response = self.model.tokenizer.decode(ids[i].tolist() + tokens, skip_special_tokens=True)
+                print(f"Prompt: {test_set[i]}\nResponse: {response}\n")
+            self.throughput['test'] = batcher.tokens_per_second
+            return
+
+        controller = BatchSizeController.for_model(self.model, memory_budget, batch_size, logits=True)
+        controller.run(
+            len(test_set),
+            lambda start, size: (test_set[start:start + size],),
+            generate_batch,
+            lambda start, size: self.tokenize_instructions_fn(test_set[start:start + size]).shape[1] + max_tokens_generated
+        )
+        self.batch_sizes['test'] = controller.sizes
+
     # Utility functions
 
+    @staticmethod
     def batch(iterable, n):
         it = iter(iterable)
         while True:
@@ -294,6 +499,7 @@ class ReverseAbliterator:
                 break
             yield chunk
 
+    @staticmethod
     def prepare_dataset(dataset: Tuple[List[str], List[str]]|List[str]) -> Tuple[List[str], List[str]]:
         from sklearn.model_selection import train_test_split
         if len(dataset) != 2:
@@ -308,6 +514,7 @@ class ReverseAbliterator:
         W_O: bool = True,
         mlp: bool = True,
         strength: float = 1.0,
+        subspace: bool = False,
     ):
         enhancement_directions = self.enhancement_dirs()
         self.apply_enhancement_dirs(
@@ -315,7 +522,8 @@ class ReverseAbliterator:
             W_O=W_O,
             mlp=mlp,
             layers=layers,
-            strength=strength
+            strength=strength,
+            subspace=subspace
         )
         self.modified = True  # Set the modified flag
 
@@ -344,7 +552,9 @@ class ReverseAbliterator:
         if not os.path.exists(load_path):
             raise FileNotFoundError(f"No model found at {load_path}")
         
-        state_dict = torch.load(load_path, map_location=self.model.device)
+        state_dict = torch.load(load_path, map_location=self.model.cfg.device)
+        # spill the original of every entry the loaded weights change, so `reset_state`/`reset_model` can restore it
+        self.loaded_keys.update(self.original_state.keep_changed(state_dict))
         self.model.load_state_dict(state_dict)
         self.modified = True
         print(f"Model loaded from {load_path}")
@@ -353,8 +563,11 @@ class ReverseAbliterator:
         """
         Reset the model to its original state.
         """
-        self.model.load_state_dict(self.original_state)
+        # every matrix that was edited or loaded over has been spilled, so restoring those restores the model
+        self.model.load_state_dict(dict(self.original_state), strict=False)
         self.modified = False
+        self.modified_layers = {'mlp':{}, 'W_O':{}}
+        self.loaded_keys = set()
         print("Model reset to original state")
 
 if __name__ == "__main__":
@@ -391,6 +604,6 @@ if __name__ == "__main__":
     reverse_abliterator.test_enhancement(N=3, max_tokens_generated=30)
 
     # Save the modified model state if desired
-    reverse_abliterator.save_activations("enhanced_model_state.pt")
+    reverse_abliterator.save_activations("enhanced_model_state")
 
     print("Reverse abliteration process complete.")
\ No newline at end of file
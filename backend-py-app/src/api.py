@@ -73,6 +73,21 @@ async def abliterate(config: EnhanceConfig):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/pretokenize")
+def pretokenize():
+    # a plain `def`, so FastAPI runs the CPU-bound tokenization in its threadpool rather than on the event loop
+    if abliterator is None and reverse_abliterator is None:
+        raise HTTPException(status_code=400, detail="No abliterator initialized")
+    try:
+        paths = {}
+        if abliterator is not None:
+            paths["abliterator"] = abliterator.pretokenize()
+        if reverse_abliterator is not None:
+            paths["reverse_abliterator"] = reverse_abliterator.pretokenize()
+        return {"message": "Training sets pre-tokenized", "paths": paths}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/enhance")
 async def enhance(config: EnhanceConfig):
     if reverse_abliterator is None:
@@ -89,22 +104,22 @@ async def enhance(config: EnhanceConfig):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/test_abliterator")
-async def test_abliterator(N: int = 16, batch_size: int = 4):
+async def test_abliterator(N: int = 16, batch_size: int = 4, memory_budget: Optional[int] = None):
     if abliterator is None:
         raise HTTPException(status_code=400, detail="Abliterator not initialized")
     try:
-        results = abliterator.test(N=N, batch_size=batch_size)
-        return {"results": results}
+        results = abliterator.test(N=N, batch_size=batch_size, memory_budget=memory_budget)
+        return {"results": results, "batch_sizes": abliterator.batch_sizes.get('test'), "tokens_per_second": abliterator.throughput.get('test')}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/test_reverse_abliterator")
-async def test_reverse_abliterator(N: int = 16, batch_size: int = 4, max_tokens_generated: int = 64):
+async def test_reverse_abliterator(N: int = 16, batch_size: int = 4, max_tokens_generated: int = 64, memory_budget: Optional[int] = None):
     if reverse_abliterator is None:
         raise HTTPException(status_code=400, detail="ReverseAbliterator not initialized")
     try:
-        results = reverse_abliterator.test_enhancement(N=N, batch_size=batch_size, max_tokens_generated=max_tokens_generated)
-        return {"results": results}
+        results = reverse_abliterator.test_enhancement(N=N, batch_size=batch_size, max_tokens_generated=max_tokens_generated, memory_budget=memory_budget)
+        return {"results": results, "batch_sizes": reverse_abliterator.batch_sizes.get('test'), "tokens_per_second": reverse_abliterator.throughput.get('test')}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -160,8 +175,15 @@ async def load_huggingface_dataset(request: dict):
             reverse_abliterator.baseline_inst_train, reverse_abliterator.baseline_inst_test = \
                 reverse_abliterator.prepare_dataset(baseline_instructions)
             
-            # Recache activations with new data
-            reverse_abliterator.cache_activations(N=len(target_instructions), batch_size=8)
+            # Merge only new prompts when the new dataset extends the cached one; otherwise the old prompts
+            # would stay in the statistics, so everything is recached
+            cached = reverse_abliterator.cached_prompts
+            extends = (
+                cached is not None and None not in cached.values()
+                and set(cached['target']) <= set(reverse_abliterator.target_inst_train)
+                and set(cached['baseline']) <= set(reverse_abliterator.baseline_inst_train)
+            )
+            reverse_abliterator.cache_activations(N=len(target_instructions), batch_size=8, append=extends, preserve_baseline=extends)
 
         return {
             "message": f"Successfully loaded dataset from {repo_id}",